@@ -0,0 +1,6 @@
+"""pytest configuration: make wrap_lockfile importable from the repository root."""
+
+import sys
+import pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -13,15 +13,23 @@ import sys
 import time
 import threading
 import shutil
-
-# Add parent directory to path to import ColDoc modules
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+# Under pytest, conftest.py makes wrap_lockfile importable; otherwise, as when
+# run as a script (as the pre-commit hook does) or by unittest from this
+# directory, add the parent directory to the path
+try:
+    import wrap_lockfile
+except ImportError:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import wrap_lockfile
 from wrap_lockfile import (
     mylockfile,
     myLockTimeout,
     mylockfile_exceptions,
     atomic_write_content_with_lock,
+    atomic_write_many,
     atomic_write_no_lock,
     atomic_write_lock,
     open_modes_behaviour,
@@ -36,34 +44,285 @@ if HAVE_FCNTL:
     from wrap_lockfile import FcntlFileLock
 
 
-class TestFcntlFileLock(unittest.TestCase):
-    """Test the FcntlFileLock implementation directly (only if fcntl available)."""
+# Platform checks used by the skip decorators, evaluated once
+IS_WINDOWS = sys.platform.startswith('win')
+
+# RAM-backed directory used for all temporary files, when available
+SHM_DIR = '/dev/shm'
+
+_saved_tempdir = None
+_module_tempdir = None
+# Unix socket shared by the tests checking that sockets are rejected
+_unix_socket = None
+_unix_socket_path = None
+_unix_socket_error = None
+
+
+def setUpModule():
+    """Create the temporary directory holding all files of the module's tests.
+
+    It is on tmpfs (if available) so that the tests are not bound by disk
+    latency, and it is removed in one go by tearDownModule.
+    """
+    global _saved_tempdir, _module_tempdir
+    global _unix_socket, _unix_socket_path, _unix_socket_error
+    shm_dir = None
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK | os.X_OK):
+        shm_dir = SHM_DIR
+    _saved_tempdir = tempfile.tempdir
+    _module_tempdir = tempfile.mkdtemp(prefix='test_wrap_lockfile_', dir=shm_dir)
+    tempfile.tempdir = _module_tempdir
+
+    if hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        path = os.path.join(_module_tempdir, 'test.sock')
+        try:
+            sock.bind(path)
+        except OSError as exc:
+            sock.close()
+            _unix_socket_error = exc
+        else:
+            _unix_socket, _unix_socket_path = sock, path
+
+
+def tearDownModule():
+    """Restore the default temporary directory and remove the module's one."""
+    global _module_tempdir, _unix_socket, _unix_socket_path
+    if _unix_socket is not None:
+        _unix_socket.close()
+        _unix_socket = _unix_socket_path = None
+    if _module_tempdir is not None:
+        tempfile.tempdir = _saved_tempdir
+        shutil.rmtree(_module_tempdir, ignore_errors=True)
+        _module_tempdir = None
+
+
+class _SharedTempDirTestCase(unittest.TestCase):
+    """Base class for tests working on files in a temporary directory.
+
+    The directory is created once per class, and each test works on its own
+    file in it, named after the test method. The directory is not removed
+    by the class: it lives in the module's temporary directory, that
+    tearDownModule removes at the end of the run.
+    """
+
+    temp_dir_prefix = 'test_'
+    # Number of worker threads of the class pool
+    pool_workers = 8
+
+    @classmethod
+    def setUpClass(cls):
+        """Create a temporary directory shared by the tests of the class."""
+        super().setUpClass()
+        cls.test_dir = tempfile.mkdtemp(prefix=cls.temp_dir_prefix)
+        # Worker threads for the concurrency tests, reused across tests
+        cls.pool = ThreadPoolExecutor(max_workers=cls.pool_workers)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the worker threads."""
+        cls.pool.shutdown(wait=True)
+        super().tearDownClass()
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def setUp(self):
-        """Create a temporary directory for test files."""
-        self.test_dir = tempfile.mkdtemp(prefix='test_fcntl_lock_')
-        self.test_file = os.path.join(self.test_dir, 'testfile.txt')
+        """Compute the name of the test file and of its sibling files."""
+        self.test_file = os.path.join(self.test_dir, self._testMethodName + '.txt')
+        self.temp_file = self.test_file + '~~'
+        self.lock_file = self.test_file + '.lock'
+        self.tmp_file = self.test_file + '.tmp'
+        # tearDown removes the files whose name starts with the test file's
+        # name; tests creating files with other names add them here
+        self._created = []
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def tearDown(self):
-        """Clean up temporary directory."""
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
+        """Remove the files created by the test, including leftover temporary files."""
+        prefix = os.path.basename(self.test_file)
+        with os.scandir(self.test_dir) as entries:
+            paths = [e.path for e in entries
+                     if e.name.startswith(prefix) and not e.is_dir(follow_symlinks=False)]
+        for path in paths + self._created:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def assert_dir_contents(self, d, present=(), absent=()):
+        """Assert that the basenames in present are in directory d, and those in absent are not."""
+        with os.scandir(d) as entries:
+            names = {e.name for e in entries}
+        self.assertLessEqual(set(present), names)
+        self.assertTrue(set(absent).isdisjoint(names),
+                        f"{sorted(set(absent) & names)} should not be in {d}")
+
+    def get_unix_socket_path(self):
+        """Return the path of the module's Unix socket, skipping the test if there is none."""
+        if _unix_socket_path is None:
+            self.skipTest(f"Cannot create Unix socket: {_unix_socket_error}")
+        return _unix_socket_path
+
+    def _assert_preserves_permissions(self, write_fn, cases):
+        """Check that writing an existing file preserves its permissions.
+
+        For each (mode, permissions, content) case, a file with the given
+        permissions is created and then written by calling
+        write_fn(path, mode, content); in append mode the original content
+        must be kept.
+        """
+        for mode, permissions, content in cases:
+            with self.subTest(mode=mode, permissions=oct(permissions)):
+                binary = 'b' in mode
+                initial = b'initial content\n' if binary else 'initial content\n'
+                with open(self.test_file, 'wb' if binary else 'w') as f:
+                    f.write(initial)
+                os.chmod(self.test_file, permissions)
+                original_mode = os.stat(self.test_file).st_mode
+
+                write_fn(self.test_file, mode, content)
+
+                new_mode = os.stat(self.test_file).st_mode
+                self.assertEqual(original_mode, new_mode,
+                                 f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
+                with open(self.test_file, 'rb' if binary else 'r') as f:
+                    expected = initial + content if 'a' in mode else content
+                    self.assertEqual(f.read(), expected)
+
+
+    def _assert_preserves_symlink(self, write_fn):
+        """Check that writing through a symlink updates its target and keeps the link.
+
+        A symlink in the test directory pointing to a file in a subdirectory
+        is written by calling write_fn(path, content); if write_fn returns the
+        name of the temporary file it wrote to, that must be in the target's
+        directory.
+        """
+        # Create the actual target file in a subdirectory
+        subdir = os.path.join(self.test_dir, 'subdir')
+        os.makedirs(subdir)
+        self.addCleanup(shutil.rmtree, subdir)
+        target_file = os.path.join(subdir, 'target.txt')
+        with open(target_file, 'w') as f:
+            f.write('original content')
+
+        # Create a symlink in the parent directory pointing to the target
+        symlink_path = os.path.join(self.test_dir, 'symlink.txt')
+        os.symlink(target_file, symlink_path)
+        self._created.append(symlink_path)
+
+        temp_filename = write_fn(symlink_path, 'updated content')
+        if temp_filename is not None:
+            self.assertEqual(os.path.dirname(temp_filename), subdir,
+                             f"Temp file {temp_filename} should be in {subdir}")
+
+        # Verify symlink is still a symlink, pointing to the same target
+        self.assertTrue(os.path.islink(symlink_path),
+                        "Symlink should be preserved, not replaced with regular file")
+        self.assertEqual(os.readlink(symlink_path), target_file)
+
+        # Verify content was updated in the target file
+        with open(target_file, 'r') as f:
+            self.assertEqual(f.read(), 'updated content')
+
+        # Verify no temp files left in subdirectory; the lock file is kept for reuse
+        remaining_files = [n for n in os.listdir(subdir) if not n.endswith('.lock')]
+        self.assertEqual(remaining_files, ['target.txt'],
+                        f"Only target.txt should remain in subdir, found: {remaining_files}")
+
+
+@unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
+class TestFcntlFileLock(_SharedTempDirTestCase):
+    """Test the FcntlFileLock implementation directly (only if fcntl available)."""
+
+    temp_dir_prefix = 'test_fcntl_lock_'
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def test_fcntl_lock_creates_lockfile(self):
-        """Test that FcntlFileLock creates a .lock file."""
+        """Test that FcntlFileLock creates a .lock file, and keeps it after release."""
         lock = FcntlFileLock(self.test_file)
+        lockfile_name = os.path.basename(self.lock_file)
         with lock:
             # Lock file should exist while locked
-            lockfile_path = self.test_file + '.lock'
-            self.assertTrue(os.path.exists(lockfile_path))
+            self.assert_dir_contents(self.test_dir, present=[lockfile_name])
+
+        self.assert_dir_contents(self.test_dir, present=[lockfile_name])
+
+    def test_fcntl_lock_reuses_idle_lock_file(self):
+        """Test that the descriptor of the lock file is kept open, unlocked, for the next acquisition."""
+        import fcntl
+        key = os.path.abspath(self.lock_file)
+        with FcntlFileLock(self.test_file) as lock:
+            fd = lock.fd
+        self.assertEqual(wrap_lockfile._idle_lock_fds.get(key), fd)
+
+        # Another open file description can lock it meanwhile
+        other = os.open(self.lock_file, os.O_WRONLY)
+        try:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(other)
+
+        with FcntlFileLock(self.test_file) as lock:
+            self.assertEqual(lock.fd, fd)
+            self.assertNotIn(key, wrap_lockfile._idle_lock_fds)
+
+    def test_lock_closes_lock_file_without_keep_idle_fd(self):
+        """Test that a lock class with _keep_idle_fd false, as msvcrtFileLock, closes the lock file on release."""
+        class ClosingLock(FcntlFileLock):
+            _keep_idle_fd = False
+
+        key = os.path.abspath(self.lock_file)
+        with ClosingLock(self.test_file) as lock:
+            fd = lock.fd
+        self.assertNotIn(key, wrap_lockfile._idle_lock_fds)
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+        # The lock file stays on disk
+        self.assertTrue(os.path.exists(self.lock_file))
+
+    def test_fcntl_lock_reentrant(self):
+        """Test that the thread holding the lock can enter the same lock object again."""
+        key = os.path.abspath(self.lock_file)
+        lock = FcntlFileLock(self.test_file, timeout=0)
+        with lock:
+            fd = lock.fd
+            with lock:
+                self.assertEqual(lock.fd, fd)
+            # Still held after the inner exit
+            self.assertEqual(lock.fd, fd)
+            with self.assertRaises(LockTimeout):
+                with FcntlFileLock(self.test_file, timeout=0):
+                    pass
+        self.assertIsNone(lock.fd)
+        self.assertNotIn(key, wrap_lockfile._path_locks)
 
-        # Lock file should be cleaned up after release
-        self.assertFalse(os.path.exists(lockfile_path))
+    def test_fcntl_lock_close(self):
+        """Test that close() closes the idle descriptor of the lock file."""
+        key = os.path.abspath(self.lock_file)
+        lock = FcntlFileLock(self.test_file)
+        with lock:
+            fd = lock.fd
+        lock.close()
+        self.assertNotIn(key, wrap_lockfile._idle_lock_fds)
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+        # The lock can still be used
+        with lock:
+            pass
+
+    def test_fcntl_lock_bounds_idle_lock_files(self):
+        """Test that the least recently used idle lock file descriptors are closed."""
+        idle_max = wrap_lockfile._IDLE_LOCK_FDS_MAX
+        names = [f'{self.test_file}.{i}' for i in range(idle_max + 1)]
+        self._created.extend(name + '.lock' for name in names)
+        fds = []
+        for name in names:
+            with FcntlFileLock(name) as lock:
+                fds.append(lock.fd)
+
+        self.assertLessEqual(len(wrap_lockfile._idle_lock_fds), idle_max)
+        self.assertNotIn(os.path.abspath(names[0] + '.lock'), wrap_lockfile._idle_lock_fds)
+        self.assertIn(os.path.abspath(names[-1] + '.lock'), wrap_lockfile._idle_lock_fds)
+        with self.assertRaises(OSError):
+            os.fstat(fds[0])
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def test_fcntl_lock_basic_acquire_release(self):
         """Test basic FcntlFileLock acquisition and release."""
         lock = FcntlFileLock(self.test_file)
@@ -72,7 +331,6 @@ class TestFcntlFileLock(unittest.TestCase):
             pass
         # Should successfully release
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def test_fcntl_lock_timeout(self):
         """Test that FcntlFileLock respects timeout."""
         # Acquire lock in one thread
@@ -80,60 +338,209 @@ class TestFcntlFileLock(unittest.TestCase):
         lock1.__enter__()
 
         try:
-            # Try to acquire with short timeout in same process
-            lock2 = FcntlFileLock(self.test_file, timeout=0.1)
-            start_time = time.time()
-
+            # A zero timeout fails at once, as the lock is held in the same process
+            lock2 = FcntlFileLock(self.test_file, timeout=0)
             with self.assertRaises(LockTimeout):
                 lock2.__enter__()
 
-            elapsed = time.time() - start_time
-            # Should timeout around 0.1 seconds
-            self.assertGreater(elapsed, 0.05)
-            self.assertLess(elapsed, 0.5)
-
         finally:
             # Release first lock
             lock1.__exit__(None, None, None)
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
+    def test_fcntl_lock_timeout_held_by_other_description(self):
+        """Test the timeout when the lock file is locked through another open file, as another process would."""
+        import fcntl
+        fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            lock = FcntlFileLock(self.test_file, timeout=0.1)
+            start_time = time.monotonic()
+
+            with self.assertRaises(LockTimeout):
+                lock.__enter__()
+
+            elapsed = time.monotonic() - start_time
+            self.assertGreaterEqual(elapsed, 0.1)
+            self.assertLess(elapsed, 0.5)
+        finally:
+            os.close(fd)
+
+    def test_fcntl_lock_excludes_other_descriptions_in_process(self):
+        """Test that the lock excludes other open files of the same process, and survives closing them."""
+        import fcntl
+        with FcntlFileLock(self.test_file):
+            for _ in range(2):
+                fd = os.open(self.lock_file, os.O_WRONLY)
+                try:
+                    with self.assertRaises(BlockingIOError):
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                finally:
+                    # Unlike a POSIX fcntl lock, this does not release the lock
+                    os.close(fd)
+
+    def test_fcntl_lock_wakes_when_other_description_releases(self):
+        """Test that a timed wait acquires the lock as soon as it is released, leaving SIGALRM as it was."""
+        import fcntl
+        import signal
+        previous_handler = signal.getsignal(signal.SIGALRM)
+        fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        releaser = threading.Timer(0.05, os.close, (fd,))
+        releaser.start()
+        try:
+            with FcntlFileLock(self.test_file, timeout=2):
+                pass
+        finally:
+            releaser.join()
+
+        self.assertEqual(signal.getsignal(signal.SIGALRM), previous_handler)
+        if hasattr(signal, 'getitimer'):
+            self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def test_fcntl_lock_alarm_wait(self):
+        """Test the SIGALRM wait: only without other threads, and with a timer clamped to TIMEOUT_MAX."""
+        import fcntl
+        import signal
+        from unittest import mock
+        if threading.current_thread() is not threading.main_thread():
+            self.skipTest("SIGALRM wait needs the main thread")
+        fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        releaser = threading.Timer(0.05, os.close, (fd,))
+        releaser.start()
+        try:
+            # The releasing thread is running
+            self.assertFalse(wrap_lockfile._lock_alarm_available())
+            with mock.patch.object(threading, 'active_count', return_value=1), \
+                    mock.patch.object(signal, 'setitimer', wraps=signal.setitimer) as setitimer:
+                with FcntlFileLock(self.test_file, timeout=float('inf')):
+                    pass
+        finally:
+            releaser.join()
+
+        self.assertEqual(setitimer.call_args_list[0],
+                         mock.call(signal.ITIMER_REAL, threading.TIMEOUT_MAX))
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
     def test_fcntl_lock_concurrent_access(self):
         """Test that FcntlFileLock properly serializes concurrent access."""
+        # More acquisitions than pool workers, so that all the workers keep contending
+        num_acquisitions = 4 * self.pool_workers
         results = []
 
-        def lock_and_append(value, hold_time=0.05):
-            """Acquire lock, append to results, hold briefly, release."""
+        def lock_and_append(value, hold_time=0.001):
+            """Acquire lock, record it, hold briefly, release."""
             lock = FcntlFileLock(self.test_file, timeout=2)
             with lock:
-                results.append('acquired_%d' % value)
+                results.append(('acq', value, time.monotonic_ns()))
                 time.sleep(hold_time)
-                results.append('releasing_%d' % value)
-
-        # Start multiple threads
-        threads = []
-        for i in range(3):
-            t = threading.Thread(target=lock_and_append, args=(i,))
-            threads.append(t)
-            t.start()
-
-        # Wait for all threads
-        for t in threads:
-            t.join(timeout=5)
-
-        # Verify results show proper serialization
-        # Each acquire should be followed by its release before next acquire
-        self.assertEqual(len(results), 6)  # 3 acquires + 3 releases
-
-        # Check that releases happen in order
-        for i in range(3):
-            acquire_idx = results.index('acquired_%d' % i)
-            release_idx = results.index('releasing_%d' % i)
-            self.assertLess(acquire_idx, release_idx)
-
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
+                results.append(('rel', value, time.monotonic_ns()))
+
+        # Run concurrently on the pool and wait for all of them
+        list(self.pool.map(lock_and_append, range(num_acquisitions), timeout=5))
+
+        # Each acquisition is recorded once, and released before any other acquisition
+        self.assertEqual(len(results), 2 * num_acquisitions)
+        idx = {(kind, i): pos for pos, (kind, i, _) in enumerate(results)}
+        self.assertEqual(len(idx), 2 * num_acquisitions)
+        for i in range(num_acquisitions):
+            self.assertEqual(idx[('rel', i)], idx[('acq', i)] + 1)
+
+    def test_fcntl_lock_drops_in_process_locks(self):
+        """Test that the in-process locks are dropped when no thread uses them."""
+        key = os.path.abspath(self.lock_file)
+        with FcntlFileLock(self.test_file):
+            self.assertIn(key, wrap_lockfile._path_locks)
+            # A timed out waiter must drop its reference too
+            with self.assertRaises(LockTimeout):
+                list(self.pool.map(lambda _: FcntlFileLock(self.test_file, timeout=0.01).__enter__(),
+                                   [None], timeout=2))
+        self.assertNotIn(key, wrap_lockfile._path_locks)
+
+    def test_fcntl_lock_huge_timeout(self):
+        """Test that timeouts beyond what threading.Lock accepts, and infinity, are allowed."""
+        for timeout in (1e10, float('inf')):
+            with self.subTest(timeout=timeout):
+                with FcntlFileLock(self.test_file, timeout=timeout) as lock:
+                    self.assertIsNotNone(lock.fd)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "os.fork not available")
+    def test_fcntl_lock_after_fork(self):
+        """Test that a child can take a lock that another thread held at fork time, once released."""
+        held, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with FcntlFileLock(self.test_file):
+                held.set()
+                release.wait(timeout=5)
+
+        holder = self.pool.submit(hold_lock)
+        self.assertTrue(held.wait(timeout=2))
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(write_fd)
+                os.read(read_fd, 1)
+                with FcntlFileLock(self.test_file, timeout=2):
+                    status = 0
+            finally:
+                os._exit(status)
+        os.close(read_fd)
+        release.set()
+        holder.result(timeout=2)
+        # The child tries once the parent has released the lock
+        os.write(write_fd, b'x')
+        os.close(write_fd)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def _wait_for_users(self, key, users, deadline=1):
+        """Wait until the in-process lock for key has the given number of users."""
+        deadline = time.monotonic() + deadline
+        while wrap_lockfile._path_locks.get(key, (None, 0))[1] != users:
+            self.assertLess(time.monotonic(), deadline, "waiter did not start")
+            time.sleep(0.001)
+
+    def test_fcntl_lock_file_shared_by_waiting_threads(self):
+        """Test that the lock file is kept open for a waiting thread."""
+        key = os.path.abspath(self.lock_file)
+        lock1 = FcntlFileLock(self.test_file)
+        lock1.__enter__()
+        try:
+            inode = os.stat(self.lock_file).st_ino
+
+            def waiter():
+                with FcntlFileLock(self.test_file, timeout=2):
+                    return os.stat(self.lock_file).st_ino
+
+            future = self.pool.submit(waiter)
+            self._wait_for_users(key, 2)
+        finally:
+            lock1.__exit__(None, None, None)
+        self.assertEqual(future.result(timeout=2), inode)
+
+    def test_fcntl_lock_reopens_removed_lock_file(self):
+        """Test that a thread does not lock a lock file that another process removed."""
+        key = os.path.abspath(self.lock_file)
+        lock1 = FcntlFileLock(self.test_file)
+        lock1.__enter__()
+        try:
+            def waiter():
+                with FcntlFileLock(self.test_file, timeout=2) as lock:
+                    return os.path.samestat(os.fstat(lock.fd), os.stat(self.lock_file))
+
+            future = self.pool.submit(waiter)
+            self._wait_for_users(key, 2)
+            # As another process does when it releases the lock
+            os.unlink(self.lock_file)
+        finally:
+            lock1.__exit__(None, None, None)
+        self.assertTrue(future.result(timeout=2))
+
     def test_fcntl_lock_cleans_up_on_exception(self):
-        """Test that FcntlFileLock cleans up .lock file even on exception."""
-        lockfile_path = self.test_file + '.lock'
+        """Test that FcntlFileLock releases the lock even on exception."""
+        import fcntl
 
         class TestException(Exception):
             pass
@@ -141,64 +548,45 @@ class TestFcntlFileLock(unittest.TestCase):
         lock = FcntlFileLock(self.test_file)
         try:
             with lock:
-                self.assertTrue(os.path.exists(lockfile_path))
+                self.assertTrue(os.path.exists(self.lock_file))
                 raise TestException("test error")
         except TestException:
             pass  # Expected
 
-        # Lock file should be cleaned up
-        self.assertFalse(os.path.exists(lockfile_path))
+        # Another open file description can lock it now
+        fd = os.open(self.lock_file, os.O_WRONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
 
-    @unittest.skipUnless(HAVE_FCNTL, "fcntl not available")
     def test_fcntl_lock_no_timeout_waits(self):
         """Test that FcntlFileLock without timeout waits indefinitely."""
-        lock_acquired = threading.Event()
-        lock_released = threading.Event()
-
-        def hold_lock_briefly():
-            """Hold lock for short time."""
-            lock1 = FcntlFileLock(self.test_file)
-            with lock1:
-                lock_acquired.set()
-                lock_released.wait(timeout=0.2)  # Hold for up to 0.2s
+        key = os.path.abspath(self.lock_file)
+        lock1 = FcntlFileLock(self.test_file)
+        lock1.__enter__()
 
         def wait_for_lock():
             """Wait for lock without timeout."""
-            lock_acquired.wait(timeout=1)  # Wait for first lock
-            lock2 = FcntlFileLock(self.test_file)  # No timeout
-            with lock2:
+            with FcntlFileLock(self.test_file):  # No timeout
                 pass  # Should eventually acquire
 
-        t1 = threading.Thread(target=hold_lock_briefly)
-        t2 = threading.Thread(target=wait_for_lock)
-
-        t1.start()
-        t2.start()
-
-        # Release first lock after short delay
-        time.sleep(0.1)
-        lock_released.set()
-
-        t1.join(timeout=2)
-        t2.join(timeout=2)
+        try:
+            waiter = self.pool.submit(wait_for_lock)
+            # Release the lock as soon as the waiter is blocked on it
+            self._wait_for_users(key, 2)
+            self.assertFalse(waiter.done())
+        finally:
+            lock1.__exit__(None, None, None)
 
-        # Both threads should complete successfully
-        self.assertFalse(t1.is_alive())
-        self.assertFalse(t2.is_alive())
+        # The waiter should then complete successfully
+        waiter.result(timeout=0.5)
 
 
-class TestAtomicWriteWithLock(unittest.TestCase):
+class TestAtomicWriteWithLock(_SharedTempDirTestCase):
     """Test the atomic_write_content_with_lock function."""
 
-    def setUp(self):
-        """Create a temporary directory for test files."""
-        self.test_dir = tempfile.mkdtemp(prefix='test_atomic_write_')
-        self.test_file = os.path.join(self.test_dir, 'testfile.txt')
-
-    def tearDown(self):
-        """Clean up temporary directory."""
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
+    temp_dir_prefix = 'test_atomic_write_'
 
     def test_atomic_write_creates_file(self):
         """Test that atomic write creates a new file."""
@@ -235,29 +623,264 @@ class TestAtomicWriteWithLock(unittest.TestCase):
             result = f.read()
         self.assertEqual(result, content)
 
+    def test_atomic_write_large_bytes(self):
+        """Test writing bytes content large enough to be preallocated."""
+        content = os.urandom(2 * 1024 * 1024 + 3)
+
+        atomic_write_content_with_lock(self.test_file, content)
+
+        self.assertEqual(os.path.getsize(self.test_file), len(content))
+        with open(self.test_file, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_atomic_write_non_ascii_text(self):
+        """Test that text content is encoded as by a file opened in text mode."""
+        content = "caf\u00e9\nna\u00efve\n"
+
+        atomic_write_content_with_lock(self.test_file, content)
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_atomic_write_large_text(self):
+        """Test that long text content, encoded in slices, is written whole."""
+        line = "caf\u00e9 \u20ac %d\n"
+        content = ''.join(line % i for i in range(200000))
+        self.assertGreater(len(content), wrap_lockfile._ENCODE_AT_ONCE_MAX)
+
+        atomic_write_content_with_lock(self.test_file, content)
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_atomic_write_durable(self):
+        """Test that durable=True syncs the temporary file, and its directory on POSIX."""
+        from unittest import mock
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            atomic_write_content_with_lock(self.test_file, "first")
+            fsync.assert_not_called()
+            atomic_write_content_with_lock(self.test_file, "second", durable=True)
+            self.assertEqual(fsync.call_count, 2 if hasattr(os, 'O_DIRECTORY') else 1)
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), "second")
+
+    @unittest.skipUnless(hasattr(os, 'O_DIRECTORY'), "directories cannot be synced here")
+    def test_atomic_write_durable_unreadable_dir(self):
+        """Test that a durable write succeeds when its directory cannot be opened to sync it."""
+        import errno
+        from unittest import mock
+        real_open = os.open
+
+        def refuse_directories(path, flags, *args, **kwargs):
+            if flags & os.O_DIRECTORY:
+                raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+            return real_open(path, flags, *args, **kwargs)
+
+        with mock.patch.object(os, 'open', side_effect=refuse_directories):
+            atomic_write_content_with_lock(self.test_file, "durable", durable=True)
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), "durable")
+
+    def test_atomic_write_many(self):
+        """Test writing several files at once, from a mapping or from pairs."""
+        first, second = self.test_file + '.first', self.test_file + '.second'
+        with open(first, 'w') as f:
+            f.write('old')
+
+        atomic_write_many({first: 'first content', second: b'second content'})
+        with open(first, 'r') as f:
+            self.assertEqual(f.read(), 'first content')
+        with open(second, 'rb') as f:
+            self.assertEqual(f.read(), b'second content')
+
+        # A later pair for the same file wins
+        atomic_write_many([(first, 'one'), (second, 'two'), (first, 'three')],
+                          use_lock=False, max_workers=1)
+        with open(first, 'r') as f:
+            self.assertEqual(f.read(), 'three')
+        with open(second, 'r') as f:
+            self.assertEqual(f.read(), 'two')
+
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any(e.name.endswith('.tmp') for e in entries))
+
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_atomic_write_many_same_file_through_symlink(self):
+        """Test that a symlink and the direct path to one file are merged, not locked twice."""
+        subdir = self.test_file + '.dir'
+        os.mkdir(subdir)
+        self.addCleanup(os.rmdir, subdir)
+        link = self.test_file + '.link'
+        os.symlink(os.path.join(os.path.basename(subdir), '..', os.path.basename(self.test_file)), link)
+
+        atomic_write_many([(self.test_file, 'direct'), (link, 'through link')], timeout=2)
+
+        self.assertTrue(os.path.islink(link))
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), 'through link')
+
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_atomic_write_many_same_file_through_symlinked_dir(self):
+        """Test that paths to one file through a directory and a symlink to it are merged."""
+        real = self.test_file + '.real'
+        os.mkdir(real)
+        self.addCleanup(shutil.rmtree, real)
+        alias = self.test_file + '.alias'
+        os.symlink(os.path.basename(real), alias)
+        target = os.path.join(real, 'f')
+
+        atomic_write_many([(target, 'direct'), (os.path.join(alias, 'f'), 'through alias')],
+                          timeout=2)
+
+        self.assertTrue(os.path.islink(alias))
+        with open(target, 'r') as f:
+            self.assertEqual(f.read(), 'through alias')
+
+    def test_atomic_write_many_failure(self):
+        """Test that a failed write leaves all the files as they were, and no temporary file."""
+        first, second = self.test_file + '.first', self.test_file + '.second'
+        with open(first, 'w') as f:
+            f.write('old')
+
+        with self.assertRaises(TypeError):
+            atomic_write_many({first: 'new', second: 42})
+
+        with open(first, 'r') as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertFalse(os.path.exists(second))
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any(e.name.endswith('.tmp') for e in entries))
+
+    def test_atomic_write_many_durable(self):
+        """Test that durable=True syncs each temporary file, and their directory once."""
+        from unittest import mock
+        paths = [self.test_file + '.%d' % i for i in range(3)]
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            atomic_write_many([(path, path) for path in paths], durable=True)
+            self.assertEqual(fsync.call_count, 4 if hasattr(os, 'O_DIRECTORY') else 3)
+
+        for path in paths:
+            with open(path, 'r') as f:
+                self.assertEqual(f.read(), path)
+
     def test_atomic_write_no_temp_file_left_on_success(self):
         """Test that temporary file is cleaned up on success."""
         content = "test content"
-        temp_file = self.test_file + '~~'
 
         atomic_write_content_with_lock(self.test_file, content)
 
-        # Temp file should not exist
-        self.assertFalse(os.path.exists(temp_file))
-        # Target file should exist
-        self.assertTrue(os.path.exists(self.test_file))
+        # Target file should exist, temp file should not
+        self.assert_dir_contents(self.test_dir,
+                                 present=[os.path.basename(self.test_file)],
+                                 absent=[os.path.basename(self.temp_file)])
 
     def test_atomic_write_custom_temp_suffix(self):
         """Test atomic write with custom temp suffix."""
         content = "test content"
-        custom_suffix = '.tmp'
 
-        atomic_write_content_with_lock(self.test_file, content, temp_suffix=custom_suffix)
+        atomic_write_content_with_lock(self.test_file, content, temp_suffix='.tmp')
+
+        # Target file should exist, custom temp file should not
+        self.assert_dir_contents(self.test_dir,
+                                 present=[os.path.basename(self.test_file)],
+                                 absent=[os.path.basename(self.tmp_file)])
+
+    def test_atomic_write_skips_existing_temp_name(self):
+        """Test that a stale file with the next temporary name is neither used nor removed."""
+        import itertools
+        saved_counter = wrap_lockfile._temp_counter
+        self.addCleanup(setattr, wrap_lockfile, '_temp_counter', saved_counter)
+        wrap_lockfile._temp_counter = itertools.count()
+        stale = '%s_%d.0.tmp' % (self.test_file, os.getpid())
+        with open(stale, 'w') as f:
+            f.write('stale')
+
+        atomic_write_content_with_lock(self.test_file, "content")
+
+        with open(self.test_file) as f:
+            self.assertEqual(f.read(), "content")
+        with open(stale) as f:
+            self.assertEqual(f.read(), "stale")
+
+    @unittest.skipUnless(getattr(wrap_lockfile, '_use_o_tmpfile', False), "O_TMPFILE not available")
+    def test_atomic_write_unnamed_temp_file(self):
+        """Test that the content is written to an unnamed file, named only once complete."""
+        from unittest import mock
+        with mock.patch.object(wrap_lockfile, '_create_temp_file', side_effect=AssertionError('named')):
+            atomic_write_content_with_lock(self.test_file, "content")
+
+        with open(self.test_file) as f:
+            self.assertEqual(f.read(), "content")
+        self.assertTrue(wrap_lockfile._use_o_tmpfile)
+
+    @unittest.skipUnless(getattr(wrap_lockfile, '_use_o_tmpfile', False), "O_TMPFILE not available")
+    def test_atomic_write_unnamed_temp_file_link_not_found(self):
+        """Test that O_TMPFILE is given up only when /proc/self/fd is missing."""
+        import errno
+        from unittest import mock
+        missing = FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT))
+        self.addCleanup(setattr, wrap_lockfile, '_use_o_tmpfile', True)
+
+        # As when the directory is removed meanwhile
+        with mock.patch.object(os, 'link', side_effect=missing):
+            with self.assertRaises(FileNotFoundError):
+                atomic_write_content_with_lock(self.test_file, "lost")
+        self.assertTrue(wrap_lockfile._use_o_tmpfile)
+
+        real_isdir = os.path.isdir
+        with mock.patch.object(os, 'link', side_effect=missing), \
+                mock.patch.object(os.path, 'isdir',
+                                  side_effect=lambda p: p != '/proc/self/fd' and real_isdir(p)):
+            atomic_write_content_with_lock(self.test_file, "named")
+        self.assertFalse(wrap_lockfile._use_o_tmpfile)
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), "named")
+
+    @unittest.skipUnless(getattr(wrap_lockfile, '_use_o_tmpfile', False), "O_TMPFILE not available")
+    def test_atomic_write_unreadable_dir_fallback(self):
+        """Test the fallback to a named temporary file when the directory cannot be opened."""
+        import errno
+        from unittest import mock
+        real_open = os.open
 
-        # Custom temp file should not exist
-        self.assertFalse(os.path.exists(self.test_file + custom_suffix))
-        # Target file should exist
-        self.assertTrue(os.path.exists(self.test_file))
+        def refuse_directories(path, flags, *args, **kwargs):
+            if flags & os.O_DIRECTORY:
+                raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+            return real_open(path, flags, *args, **kwargs)
+
+        with mock.patch.object(os, 'open', side_effect=refuse_directories):
+            atomic_write_content_with_lock(self.test_file, "fallback")
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), "fallback")
+
+    @unittest.skipIf(IS_WINDOWS or os.geteuid() == 0, "needs Unix permissions enforced, not root")
+    def test_atomic_write_write_only_dir(self):
+        """Test writing into a directory with write and search permission, but not read."""
+        subdir = os.path.join(self.test_dir, self._testMethodName)
+        os.mkdir(subdir)
+        path = os.path.join(subdir, 'file.txt')
+        os.chmod(subdir, 0o333)
+        try:
+            atomic_write_content_with_lock(path, "first")
+            atomic_write_content_with_lock(path, "second", durable=True)
+            with open(path, 'r') as f:
+                self.assertEqual(f.read(), "second")
+        finally:
+            os.chmod(subdir, 0o700)
+            shutil.rmtree(subdir)
+
+    def test_atomic_write_named_temp_file(self):
+        """Test the named temporary file used where O_TMPFILE is not."""
+        from unittest import mock
+        with mock.patch.object(wrap_lockfile, '_use_o_tmpfile', False):
+            atomic_write_content_with_lock(self.test_file, "content")
+
+        with open(self.test_file) as f:
+            self.assertEqual(f.read(), "content")
+        self.assert_dir_contents(self.test_dir, absent=[os.path.basename(self.temp_file)])
 
     def test_atomic_write_without_lock(self):
         """Test atomic write with locking disabled."""
@@ -269,37 +892,64 @@ class TestAtomicWriteWithLock(unittest.TestCase):
             result = f.read()
         self.assertEqual(result, content)
 
-    def test_atomic_write_concurrent_writes(self):
-        """Test that concurrent atomic writes don't corrupt the file."""
-        num_threads = 5
-        writes_per_thread = 10
+    def test_atomic_write_rename_is_atomic_for_readers(self):
+        """Test that readers only ever see complete contents while writes go on."""
+        num_writers = 3
+        writes_per_thread = 5
+        payloads = {"thread_%d_write_%d" % (t, i)
+                    for t in range(num_writers) for i in range(writes_per_thread)}
+        atomic_write_content_with_lock(self.test_file, "initial", use_lock=False)
+        # Writers are serialized in userspace; the file lock is tested elsewhere
+        write_lock = threading.Lock()
+        done = threading.Event()
+        seen = set()
 
         def writer(thread_id):
             """Write multiple times with unique content."""
             for i in range(writes_per_thread):
-                content = "thread_%d_write_%d" % (thread_id, i)
-                atomic_write_content_with_lock(self.test_file, content, timeout=5)
-                time.sleep(0.001)
-
-        # Start multiple writer threads
-        threads = []
-        for tid in range(num_threads):
-            t = threading.Thread(target=writer, args=(tid,))
-            threads.append(t)
-            t.start()
-
-        # Wait for all threads
-        for t in threads:
-            t.join(timeout=10)
-
-        # File should exist and contain valid content
-        self.assertTrue(os.path.exists(self.test_file))
+                with write_lock:
+                    atomic_write_content_with_lock(
+                        self.test_file, "thread_%d_write_%d" % (thread_id, i), use_lock=False)
+
+        def reader():
+            """Read the file until the writers are done."""
+            while not done.is_set():
+                with open(self.test_file, 'r') as f:
+                    seen.add(f.read())
+
+        reader_future = self.pool.submit(reader)
+        try:
+            list(self.pool.map(writer, range(num_writers), timeout=10))
+        finally:
+            done.set()
+        reader_future.result(timeout=10)
+
+        # Every read must be one of the complete payloads
+        self.assertLessEqual(seen, payloads | {"initial"})
         with open(self.test_file, 'r') as f:
-            final_content = f.read()
+            self.assertIn(f.read(), payloads)
 
-        # Final content should match pattern from one of the writes
-        self.assertTrue(final_content.startswith('thread_'))
-        self.assertIn('_write_', final_content)
+    def test_atomic_write_concurrent_writes(self):
+        """Smoke test that contended atomic writes don't corrupt the file."""
+        num_threads = 5
+        payloads = {"thread_%d" % t for t in range(num_threads)}
+        # Start all writers at the same time, so that they contend for the lock
+        barrier = threading.Barrier(num_threads)
+
+        def writer(thread_id):
+            """Write once with unique content."""
+            payload = "thread_%d" % thread_id
+            barrier.wait()
+            atomic_write_content_with_lock(self.test_file, payload, timeout=5)
+            return payload
+
+        # Run the writers on the pool; all of them must complete
+        written = set(self.pool.map(writer, range(num_threads), timeout=10))
+        self.assertEqual(written, payloads)
+
+        # Final content should be one of the writes
+        with open(self.test_file, 'r') as f:
+            self.assertIn(f.read(), payloads)
 
     def test_atomic_write_temp_file_cleanup_on_failure(self):
         """Test that temporary file is cleaned up even on write failure."""
@@ -316,119 +966,43 @@ class TestAtomicWriteWithLock(unittest.TestCase):
         # Temp file should not exist (cleanup should happen even on failure)
         self.assertFalse(os.path.exists(temp_file))
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Symlink test requires Unix-like system")
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
     def test_atomic_write_symlink_preserved(self):
         """Test that atomic_write_content_with_lock preserves symlinks."""
-        # Create a subdirectory for the target file
-        subdir = os.path.join(self.test_dir, 'subdir')
-        os.makedirs(subdir)
-
-        # Create the actual target file in the subdirectory
-        target_file = os.path.join(subdir, 'target.txt')
-        with open(target_file, 'w') as f:
-            f.write('original content')
-
-        # Create a symlink in the parent directory pointing to the target
-        symlink_path = os.path.join(self.test_dir, 'symlink.txt')
-        os.symlink(target_file, symlink_path)
-
-        # Verify symlink exists
-        self.assertTrue(os.path.islink(symlink_path))
-        self.assertEqual(os.readlink(symlink_path), target_file)
-
-        # Write through the symlink using atomic_write_content_with_lock
-        atomic_write_content_with_lock(symlink_path, "updated via function", use_lock=True)
-
-        # Verify symlink is still a symlink (not replaced with regular file)
-        self.assertTrue(os.path.islink(symlink_path),
-                       "Symlink should be preserved, not replaced with regular file")
-
-        # Verify symlink still points to the same target
-        self.assertEqual(os.readlink(symlink_path), target_file)
-
-        # Verify content was updated in the target file
-        with open(target_file, 'r') as f:
-            self.assertEqual(f.read(), 'updated via function')
-
-        # Verify reading through symlink works
-        with open(symlink_path, 'r') as f:
-            self.assertEqual(f.read(), 'updated via function')
-
-        # Verify no temp files left in subdirectory
-        remaining_files = os.listdir(subdir)
-        self.assertEqual(remaining_files, ['target.txt'],
-                        f"Only target.txt should remain in subdir, found: {remaining_files}")
+        def write(path, content):
+            atomic_write_content_with_lock(path, content, use_lock=True)
+        self._assert_preserves_symlink(write)
 
     def test_reject_directory(self):
         """Test that atomic_write_content_with_lock rejects directories."""
         # Create a directory
         dir_path = os.path.join(self.test_dir, 'testdir')
         os.makedirs(dir_path)
+        self.addCleanup(shutil.rmtree, dir_path)
 
         # Should fail when trying to resolve/open directory
         with self.assertRaises((RuntimeError, OSError, IOError, IsADirectoryError)):
             atomic_write_content_with_lock(dir_path, "should not work", use_lock=True)
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Unix socket test requires Unix-like system")
+    @unittest.skipIf(IS_WINDOWS, "Unix socket test requires Unix-like system")
     def test_reject_unix_socket(self):
         """Test that atomic_write_content_with_lock rejects Unix sockets."""
-        import socket
-
-        # Create a Unix socket
-        socket_path = os.path.join(self.test_dir, 'test.sock')
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            try:
-                sock.bind(socket_path)
-            except PermissionError as exc:
-                self.skipTest(f"Cannot create Unix socket in test dir: {exc}")
+        socket_path = self.get_unix_socket_path()
 
-            # Should fail when trying to open socket for writing
-            with self.assertRaises((RuntimeError, OSError, IOError)):
-                atomic_write_content_with_lock(socket_path, "should not work", use_lock=True)
+        # Should fail when trying to open socket for writing
+        with self.assertRaises((RuntimeError, OSError, IOError)):
+            atomic_write_content_with_lock(socket_path, "should not work", use_lock=True)
 
-        finally:
-            sock.close()
-            if os.path.exists(socket_path):
-                os.unlink(socket_path)
+    @unittest.skipIf(IS_WINDOWS, "File permissions test requires Unix-like system")
+    def test_preserves_permissions(self):
+        """Test that atomic_write_content_with_lock preserves file permissions with string and binary content."""
+        def write_fn(path, mode, content):
+            atomic_write_content_with_lock(path, content, use_lock=True)
 
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_string_content(self):
-        """Test that atomic_write_content_with_lock preserves file permissions with string content."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'w') as f:
-            f.write('initial content')
-
-        # Set specific permissions (e.g., 0o644 - rw-r--r--)
-        os.chmod(self.test_file, 0o644)
-        original_mode = os.stat(self.test_file).st_mode
-
-        # Write using atomic_write_content_with_lock
-        atomic_write_content_with_lock(self.test_file, 'updated content', use_lock=True)
-
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
-
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_binary_content(self):
-        """Test that atomic_write_content_with_lock preserves file permissions with binary content."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'wb') as f:
-            f.write(b'initial binary content')
-
-        # Set specific permissions (e.g., 0o600 - rw-------)
-        os.chmod(self.test_file, 0o600)
-        original_mode = os.stat(self.test_file).st_mode
-
-        # Write using atomic_write_content_with_lock with binary content
-        atomic_write_content_with_lock(self.test_file, b'updated binary content', use_lock=True)
-
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
+        self._assert_preserves_permissions(write_fn, [
+            ('w', 0o644, 'updated content'),
+            ('wb', 0o600, b'updated binary content'),
+        ])
 
     def test_append_mode_not_supported(self):
         """Test that atomic_write_content_with_lock does not support append mode (it's a simple content replacement function)."""
@@ -467,58 +1041,55 @@ class TestLockExceptions(unittest.TestCase):
         self.assertTrue(issubclass(AlreadyLocked, Exception))
         self.assertTrue(issubclass(LockFailed, Exception))
 
+    def test_exception_messages(self):
+        """Test the messages of the exceptions raised by the fallbacks, and of plain ones."""
+        import errno
+        error = OSError(errno.EBADF, os.strerror(errno.EBADF))
+        self.assertEqual(str(LockTimeout('/tmp/file', 1.25)),
+                         'Timeout waiting for lock on /tmp/file after 1.2 seconds')
+        self.assertEqual(str(LockFailed(error)), 'Failed to acquire lock: %s' % error)
+        self.assertEqual(str(LockTimeout('message')), 'message')
+        self.assertEqual(str(LockTimeout('a', 'b')), str(Exception('a', 'b')))
+        self.assertEqual(str(LockFailed('message')), 'message')
+
     def test_mylockfile_exceptions_is_tuple(self):
         """Test that mylockfile_exceptions is a tuple."""
         self.assertIsInstance(mylockfile_exceptions, tuple)
 
 
-class TestMyLockfileInterface(unittest.TestCase):
+class TestMyLockfileInterface(_SharedTempDirTestCase):
     """Test the mylockfile public interface."""
 
+    temp_dir_prefix = 'test_mylockfile_'
+
+    def setUp(self):
+        """Create the file to be locked."""
+        super().setUp()
+        with open(self.test_file, 'w'):
+            pass
+
     def test_mylockfile_is_callable(self):
         """Test that mylockfile is a callable (class or function)."""
         self.assertTrue(callable(mylockfile))
 
     def test_mylockfile_returns_context_manager(self):
         """Test that mylockfile returns a context manager."""
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp_path = tmp.name
-
-        try:
-            lock = mylockfile(tmp_path)
-            # Should have __enter__ and __exit__ methods
-            self.assertTrue(hasattr(lock, '__enter__'))
-            self.assertTrue(hasattr(lock, '__exit__'))
-        finally:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        lock = mylockfile(self.test_file)
+        # Should have __enter__ and __exit__ methods
+        self.assertTrue(hasattr(lock, '__enter__'))
+        self.assertTrue(hasattr(lock, '__exit__'))
 
     def test_mylockfile_basic_usage(self):
         """Test basic usage of mylockfile."""
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp_path = tmp.name
-
-        try:
-            # Should work regardless of implementation
-            with mylockfile(tmp_path):
-                pass
-        finally:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        # Should work regardless of implementation
+        with mylockfile(self.test_file):
+            pass
 
 
-class TestAtomicWriteNoLock(unittest.TestCase):
+class TestAtomicWriteNoLock(_SharedTempDirTestCase):
     """Test the atomic_write_no_lock context manager."""
 
-    def setUp(self):
-        """Create a temporary directory for test files."""
-        self.test_dir = tempfile.mkdtemp(prefix='test_atomic_no_lock_')
-        self.test_file = os.path.join(self.test_dir, 'testfile.txt')
-
-    def tearDown(self):
-        """Clean up temporary directory."""
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
+    temp_dir_prefix = 'test_atomic_no_lock_'
 
     def test_basic_write(self):
         """Test basic file writing."""
@@ -551,14 +1122,25 @@ class TestAtomicWriteNoLock(unittest.TestCase):
         with open(self.test_file, 'r') as f:
             self.assertEqual(f.read(), 'updated')
 
+    def test_writer_reused(self):
+        """Test that the same writer can be entered again, as in a retry loop."""
+        writer = atomic_write_no_lock(self.test_file, encoding='utf-8', suffix='.part')
+        for content in ('first', 'second'):
+            with writer as f:
+                self.assertTrue(f.name.endswith('.part'))
+                f.write(content)
+
+            with open(self.test_file, 'r') as f:
+                self.assertEqual(f.read(), content)
+
     def test_temp_file_cleaned_up_on_success(self):
         """Test that temporary file is removed after successful write."""
         with atomic_write_no_lock(self.test_file) as f:
             f.write('test')
 
         # Check no .tmp files remain
-        temp_files = [f for f in os.listdir(self.test_dir) if '.tmp' in f]
-        self.assertEqual(len(temp_files), 0)
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any('.tmp' in e.name for e in entries))
 
     def test_temp_file_cleaned_up_on_exception(self):
         """Test that temporary file is removed even on exception."""
@@ -576,8 +1158,8 @@ class TestAtomicWriteNoLock(unittest.TestCase):
         self.assertFalse(os.path.exists(self.test_file))
 
         # No temp files should remain
-        temp_files = [f for f in os.listdir(self.test_dir) if '.tmp' in f]
-        self.assertEqual(len(temp_files), 0)
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any('.tmp' in e.name for e in entries))
 
     def test_encoding_parameters(self):
         """Test that encoding parameters work correctly."""
@@ -587,63 +1169,133 @@ class TestAtomicWriteNoLock(unittest.TestCase):
         with open(self.test_file, 'r', encoding='utf-8') as f:
             self.assertEqual(f.read(), 'Hello 世界 🌍')
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Symlink test requires Unix-like system")
-    def test_symlink_preserved(self):
-        """Test that symlinks are preserved and temp files created in target directory."""
-        # Create a subdirectory for the target file
-        subdir = os.path.join(self.test_dir, 'subdir')
-        os.makedirs(subdir)
-
-        # Create the actual target file in the subdirectory
-        target_file = os.path.join(subdir, 'target.txt')
-        with open(target_file, 'w') as f:
-            f.write('original content')
+    def test_durable(self):
+        """Test that durable=True syncs the temporary file, and its directory on POSIX."""
+        from unittest import mock
+        syncs = 2 if hasattr(os, 'O_DIRECTORY') else 1
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            with atomic_write_no_lock(self.test_file) as f:
+                f.write('first')
+            fsync.assert_not_called()
+            with atomic_write_no_lock(self.test_file, durable=True) as f:
+                f.write('second')
+            self.assertEqual(fsync.call_count, syncs)
+            # Also when the caller closes the file
+            with atomic_write_no_lock(self.test_file, mode='a', durable=True) as f:
+                f.write(' third')
+                f.close()
+            self.assertEqual(fsync.call_count, 2 * syncs)
 
-        # Create a symlink in the parent directory pointing to the target
-        symlink_path = os.path.join(self.test_dir, 'symlink.txt')
-        os.symlink(target_file, symlink_path)
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), 'second third')
 
-        # Verify symlink exists
-        self.assertTrue(os.path.islink(symlink_path))
-        self.assertEqual(os.readlink(symlink_path), target_file)
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_symlink_preserved(self):
+        """Test that symlinks are preserved and temp files created in target directory."""
+        def write(path, content):
+            with atomic_write_no_lock(path) as f:
+                f.write(content)
+            return f.name
+        self._assert_preserves_symlink(write)
+
+    def test_append_copies_large_file(self):
+        """Test that append mode keeps all the existing content of a file larger than the copy buffers."""
+        initial = os.urandom(3 * 1024 * 1024 + 7)
+        with open(self.test_file, 'wb') as f:
+            f.write(initial)
 
-        # Track temp files created during the write
-        temp_files_found = []
+        with atomic_write_no_lock(self.test_file, mode='ab') as f:
+            f.write(b'tail')
 
-        # Write through the symlink
-        with atomic_write_no_lock(symlink_path) as f:
-            # Check that temp file is created in the subdirectory, not parent
-            temp_filename = f.name
-            temp_files_found.append(temp_filename)
-            self.assertTrue(temp_filename.startswith(subdir),
-                          f"Temp file {temp_filename} should be in {subdir}")
-            f.write('updated content')
+        with open(self.test_file, 'rb') as f:
+            self.assertEqual(f.read(), initial + b'tail')
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), "os.sendfile not available")
+    def test_append_copies_large_file_without_copy_file_range(self):
+        """Test the sendfile copy used when os.copy_file_range is not supported."""
+        import errno
+        from unittest import mock
+        initial = os.urandom(3 * 1024 * 1024 + 7)
+        with open(self.test_file, 'wb') as f:
+            f.write(initial)
 
-        # Verify symlink is still a symlink (not replaced with regular file)
-        self.assertTrue(os.path.islink(symlink_path),
-                       "Symlink should be preserved, not replaced with regular file")
+        unsupported = OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        with mock.patch.object(os, 'copy_file_range', side_effect=unsupported, create=True):
+            with atomic_write_no_lock(self.test_file, mode='ab') as f:
+                f.write(b'tail')
 
-        # Verify symlink still points to the same target
-        self.assertEqual(os.readlink(symlink_path), target_file)
+        with open(self.test_file, 'rb') as f:
+            self.assertEqual(f.read(), initial + b'tail')
+
+    @unittest.skipUnless(hasattr(os, 'readv'), "os.readv not available")
+    def test_append_copies_large_file_without_kernel_copy(self):
+        """Test the readv/writev copy used when neither os.copy_file_range nor os.sendfile is supported."""
+        import errno
+        from unittest import mock
+        initial = os.urandom(3 * 1024 * 1024 + 7)
+        with open(self.test_file, 'wb') as f:
+            f.write(initial)
 
-        # Verify content was updated in the target file
-        with open(target_file, 'r') as f:
-            self.assertEqual(f.read(), 'updated content')
+        unsupported = OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        with mock.patch.object(os, 'copy_file_range', side_effect=unsupported, create=True), \
+                mock.patch.object(os, 'sendfile', side_effect=unsupported, create=True):
+            with atomic_write_no_lock(self.test_file, mode='ab') as f:
+                f.write(b'tail')
 
-        # Verify reading through symlink works
-        with open(symlink_path, 'r') as f:
-            self.assertEqual(f.read(), 'updated content')
-
-        # Verify no temp files left in subdirectory
-        remaining_files = os.listdir(subdir)
-        self.assertEqual(remaining_files, ['target.txt'],
-                        f"Only target.txt should remain in subdir, found: {remaining_files}")
+        with open(self.test_file, 'rb') as f:
+            self.assertEqual(f.read(), initial + b'tail')
+
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_retargeted_symlink(self):
+        """Test that writes follow a symlink after it is replaced by one to another file."""
+        first = self.test_file + '.first'
+        second = self.test_file + '.second'
+        link = self.test_file + '.link'
+
+        os.symlink(first, link)
+        with atomic_write_no_lock(link) as f:
+            f.write('one')
+        # Replace the link atomically, so that it is a new inode
+        os.symlink(second, self.tmp_file)
+        os.replace(self.tmp_file, link)
+        with atomic_write_no_lock(link) as f:
+            f.write('two')
+
+        with open(first) as f:
+            self.assertEqual(f.read(), 'one')
+        with open(second) as f:
+            self.assertEqual(f.read(), 'two')
+
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_recreated_symlink_same_times(self):
+        """Test that writes follow a symlink recreated in place with the same timestamps."""
+        first = self.test_file + '.first'
+        second = self.test_file + '.second'
+        link = self.test_file + '.link'
+
+        os.symlink(first, link)
+        with atomic_write_no_lock(link) as f:
+            f.write('one')
+        st = os.lstat(link)
+        # Recreate the link, likely reusing its inode, and restore its times
+        os.unlink(link)
+        os.symlink(second, link)
+        if os.utime in os.supports_follow_symlinks:
+            os.utime(link, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+        with atomic_write_no_lock(link) as f:
+            f.write('two')
+
+        with open(first) as f:
+            self.assertEqual(f.read(), 'one')
+        with open(second) as f:
+            self.assertEqual(f.read(), 'two')
 
     def test_reject_directory(self):
         """Test that atomic_write_no_lock rejects directories."""
         # Create a directory
         dir_path = os.path.join(self.test_dir, 'testdir')
         os.makedirs(dir_path)
+        self.addCleanup(shutil.rmtree, dir_path)
 
         # Should raise RuntimeError for directory
         with self.assertRaises(RuntimeError) as context:
@@ -652,91 +1304,36 @@ class TestAtomicWriteNoLock(unittest.TestCase):
 
         self.assertIn('Works only on files', str(context.exception))
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Unix socket test requires Unix-like system")
+    @unittest.skipIf(IS_WINDOWS, "Unix socket test requires Unix-like system")
     def test_reject_unix_socket(self):
         """Test that atomic_write_no_lock rejects Unix sockets."""
-        import socket
+        socket_path = self.get_unix_socket_path()
 
-        # Create a Unix socket
-        socket_path = os.path.join(self.test_dir, 'test.sock')
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            try:
-                sock.bind(socket_path)
-            except PermissionError as exc:
-                self.skipTest(f"Cannot create Unix socket in test dir: {exc}")
-
-            # Should raise RuntimeError for socket
-            with self.assertRaises(RuntimeError) as context:
-                with atomic_write_no_lock(socket_path) as f:
-                    f.write('should not work')
-
-            self.assertIn('Works only on files', str(context.exception))
-
-        finally:
-            sock.close()
-            if os.path.exists(socket_path):
-                os.unlink(socket_path)
-
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_mode_w(self):
-        """Test that atomic_write_no_lock preserves file permissions with mode='w'."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'w') as f:
-            f.write('initial content')
-
-        # Set specific permissions (e.g., 0o644 - rw-r--r--)
-        os.chmod(self.test_file, 0o644)
-        original_mode = os.stat(self.test_file).st_mode
-
-        # Write using atomic_write_no_lock with mode='w'
-        with atomic_write_no_lock(self.test_file, mode='w') as f:
-            f.write('updated content')
-
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
-
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_mode_a(self):
-        """Test that atomic_write_no_lock preserves file permissions with mode='a'."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'w') as f:
-            f.write('initial content\n')
-
-        # Set specific permissions (e.g., 0o600 - rw-------)
-        os.chmod(self.test_file, 0o600)
-        original_mode = os.stat(self.test_file).st_mode
+        # Should raise RuntimeError for socket
+        with self.assertRaises(RuntimeError) as context:
+            with atomic_write_no_lock(socket_path) as f:
+                f.write('should not work')
 
-        # Write using atomic_write_no_lock with mode='a' (uses copy path)
-        with atomic_write_no_lock(self.test_file, mode='a') as f:
-            f.write('appended content\n')
+        self.assertIn('Works only on files', str(context.exception))
 
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
+    @unittest.skipIf(IS_WINDOWS, "File permissions test requires Unix-like system")
+    def test_preserves_permissions(self):
+        """Test that atomic_write_no_lock preserves file permissions with mode='w' and mode='a'."""
+        def write_fn(path, mode, content):
+            with atomic_write_no_lock(path, mode=mode) as f:
+                f.write(content)
 
-        # Verify content was actually appended
-        with open(self.test_file, 'r') as f:
-            content = f.read()
-            self.assertIn('initial content', content)
-            self.assertIn('appended content', content)
+        # mode='a' goes through the copy path
+        self._assert_preserves_permissions(write_fn, [
+            ('w', 0o644, 'updated content'),
+            ('a', 0o600, 'appended content\n'),
+        ])
 
 
-class TestAtomicWriteLock(unittest.TestCase):
+class TestAtomicWriteLock(_SharedTempDirTestCase):
     """Test the atomic_write_lock context manager."""
 
-    def setUp(self):
-        """Create a temporary directory for test files."""
-        self.test_dir = tempfile.mkdtemp(prefix='test_atomic_lock_')
-        self.test_file = os.path.join(self.test_dir, 'testfile.txt')
-
-    def tearDown(self):
-        """Clean up temporary directory."""
-        if os.path.exists(self.test_dir):
-            shutil.rmtree(self.test_dir)
+    temp_dir_prefix = 'test_atomic_lock_'
 
     def test_basic_write(self):
         """Test basic file writing with locking."""
@@ -747,6 +1344,20 @@ class TestAtomicWriteLock(unittest.TestCase):
         with open(self.test_file, 'r') as f:
             self.assertEqual(f.read(), 'Hello, World!')
 
+    def test_noop_lock_skipped(self):
+        """Test that the writers do not create the lock when no locking is available."""
+        from unittest import mock
+        with mock.patch.object(wrap_lockfile, '_LOCK_IS_NOOP', True), \
+                mock.patch.object(wrap_lockfile, 'mylockfile', side_effect=AssertionError('lock created')):
+            with atomic_write_lock(self.test_file) as f:
+                f.write('first')
+            with open(self.test_file, 'r') as f:
+                self.assertEqual(f.read(), 'first')
+
+            atomic_write_content_with_lock(self.test_file, 'second')
+            with open(self.test_file, 'r') as f:
+                self.assertEqual(f.read(), 'second')
+
     def test_binary_write(self):
         """Test binary mode writing with locking."""
         content = b'\x00\x01\x02\xff\xfe'
@@ -787,28 +1398,22 @@ class TestAtomicWriteLock(unittest.TestCase):
         def writer(thread_id, hold_time=0.05):
             """Write to file and record timing."""
             with atomic_write_lock(self.test_file, lock_timeout=5) as f:
-                results.append('start_%d' % thread_id)
+                results.append(('start', thread_id))
                 f.write('thread_%d' % thread_id)
                 time.sleep(hold_time)
-                results.append('end_%d' % thread_id)
-
-        # Start multiple threads
-        threads = []
-        for i in range(3):
-            t = threading.Thread(target=writer, args=(i,))
-            threads.append(t)
-            t.start()
+                results.append(('end', thread_id))
 
-        # Wait for all threads
-        for t in threads:
-            t.join(timeout=10)
+        # Run the writers on the pool; each holds the lock for hold_time, so allow some slack
+        futures = [self.pool.submit(writer, i) for i in range(3)]
+        for future in futures:
+            future.result(timeout=2)
 
-        # Each start should be followed by its end before next start
+        # Each start should be immediately followed by its own end
         self.assertEqual(len(results), 6)
-        for i in range(3):
-            start_idx = results.index('start_%d' % i)
-            end_idx = results.index('end_%d' % i)
-            self.assertLess(start_idx, end_idx)
+        for k in range(0, 6, 2):
+            self.assertEqual(results[k][0], 'start')
+            self.assertEqual(results[k + 1], ('end', results[k][1]))
+        self.assertEqual(sorted(tid for phase, tid in results[::2]), [0, 1, 2])
 
     def test_temp_file_cleaned_up_on_success(self):
         """Test that temporary file is removed after successful write."""
@@ -816,8 +1421,8 @@ class TestAtomicWriteLock(unittest.TestCase):
             f.write('test')
 
         # Check no .tmp files remain
-        temp_files = [f for f in os.listdir(self.test_dir) if '.tmp' in f]
-        self.assertEqual(len(temp_files), 0)
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any('.tmp' in e.name for e in entries))
 
     def test_temp_file_cleaned_up_on_exception(self):
         """Test that temporary file is removed even on exception."""
@@ -835,8 +1440,8 @@ class TestAtomicWriteLock(unittest.TestCase):
         self.assertFalse(os.path.exists(self.test_file))
 
         # No temp files should remain
-        temp_files = [f for f in os.listdir(self.test_dir) if '.tmp' in f]
-        self.assertEqual(len(temp_files), 0)
+        with os.scandir(self.test_dir) as entries:
+            self.assertFalse(any('.tmp' in e.name for e in entries))
 
     def test_lock_released_on_exception(self):
         """Test that lock is released even when exception occurs."""
@@ -857,42 +1462,56 @@ class TestAtomicWriteLock(unittest.TestCase):
         with open(self.test_file, 'r') as f:
             self.assertEqual(f.read(), 'after error')
 
+    def test_lock_released_when_temp_file_fails(self):
+        """Test that the lock is released when the temporary file cannot be created."""
+        import errno
+        from unittest import mock
+        failure = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with mock.patch.object(wrap_lockfile, '_create_temp_file', side_effect=failure):
+            with self.assertRaises(OSError):
+                with atomic_write_lock(self.test_file) as f:
+                    f.write('never written')
+
+        # Lock should be released - another thread can acquire it at once
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(self._write_with_timeout, 'after error').result()
+
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), 'after error')
+
+    def _write_with_timeout(self, content):
+        with atomic_write_lock(self.test_file, lock_timeout=1) as f:
+            f.write(content)
+
     def test_lock_timeout(self):
         """Test that lock timeout works."""
-        lock_acquired = threading.Event()
-        exception_raised = [False]
+        # Both threads pass the barrier once the lock is held
+        barrier = threading.Barrier(2)
+        attempted = threading.Event()
 
         def hold_lock():
-            """Hold lock for a while."""
-            try:
-                with atomic_write_lock(self.test_file, lock_timeout=10) as f:
-                    lock_acquired.set()
-                    f.write('holding lock')
-                    time.sleep(0.3)  # Hold lock for a while
-            except Exception:
-                pass
+            """Hold the lock until the other thread has tried to acquire it."""
+            with atomic_write_lock(self.test_file, lock_timeout=10) as f:
+                barrier.wait()
+                f.write('holding lock')
+                attempted.wait(timeout=1)
 
         def try_acquire_with_timeout():
             """Try to acquire lock with short timeout."""
+            barrier.wait()
             try:
-                lock_acquired.wait(timeout=1)  # Wait for first lock
-                with atomic_write_lock(self.test_file, lock_timeout=0.1) as f:
+                with atomic_write_lock(self.test_file, lock_timeout=0) as f:
                     f.write('should not get here')
-            except Exception as e:
-                # Catch any lock-related exception
-                exception_raised[0] = True
+            finally:
+                attempted.set()
 
-        t1 = threading.Thread(target=hold_lock)
-        t2 = threading.Thread(target=try_acquire_with_timeout)
+        holder = self.pool.submit(hold_lock)
+        acquirer = self.pool.submit(try_acquire_with_timeout)
 
-        t1.start()
-        t2.start()
-
-        t1.join(timeout=2)
-        t2.join(timeout=2)
-
-        # The second thread should have raised an exception
-        self.assertTrue(exception_raised[0], "Expected lock timeout exception was not raised")
+        # The second thread should have failed at once (the lockfile library
+        # raises AlreadyLocked rather than a timeout for a zero timeout)
+        self.assertIsInstance(acquirer.exception(timeout=1), mylockfile_exceptions)
+        holder.result(timeout=1)
 
     def test_encoding_parameters(self):
         """Test that encoding parameters work correctly."""
@@ -902,59 +1521,32 @@ class TestAtomicWriteLock(unittest.TestCase):
         with open(self.test_file, 'r', encoding='utf-8') as f:
             self.assertEqual(f.read(), 'Hello 世界 🌍')
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Symlink test requires Unix-like system")
-    def test_symlink_preserved_with_lock(self):
-        """Test that symlinks are preserved with locking and temp files created in target directory."""
-        # Create a subdirectory for the target file
-        subdir = os.path.join(self.test_dir, 'subdir')
-        os.makedirs(subdir)
-
-        # Create the actual target file in the subdirectory
-        target_file = os.path.join(subdir, 'target.txt')
-        with open(target_file, 'w') as f:
-            f.write('original content')
+    def test_durable_with_lock(self):
+        """Test that durable=True reaches the writer under the lock."""
+        from unittest import mock
+        with mock.patch.object(os, 'fsync', wraps=os.fsync) as fsync:
+            with atomic_write_lock(self.test_file, durable=True) as f:
+                f.write('durable')
+            self.assertEqual(fsync.call_count, 2 if hasattr(os, 'O_DIRECTORY') else 1)
 
-        # Create a symlink in the parent directory pointing to the target
-        symlink_path = os.path.join(self.test_dir, 'symlink.txt')
-        os.symlink(target_file, symlink_path)
-
-        # Verify symlink exists
-        self.assertTrue(os.path.islink(symlink_path))
-        self.assertEqual(os.readlink(symlink_path), target_file)
-
-        # Write through the symlink with locking
-        with atomic_write_lock(symlink_path) as f:
-            # Check that temp file is created in the subdirectory, not parent
-            temp_filename = f.name
-            self.assertTrue(temp_filename.startswith(subdir),
-                          f"Temp file {temp_filename} should be in {subdir}")
-            f.write('updated with lock')
-
-        # Verify symlink is still a symlink (not replaced with regular file)
-        self.assertTrue(os.path.islink(symlink_path),
-                       "Symlink should be preserved, not replaced with regular file")
-
-        # Verify symlink still points to the same target
-        self.assertEqual(os.readlink(symlink_path), target_file)
-
-        # Verify content was updated in the target file
-        with open(target_file, 'r') as f:
-            self.assertEqual(f.read(), 'updated with lock')
-
-        # Verify reading through symlink works
-        with open(symlink_path, 'r') as f:
-            self.assertEqual(f.read(), 'updated with lock')
+        with open(self.test_file, 'r') as f:
+            self.assertEqual(f.read(), 'durable')
 
-        # Verify no temp files left in subdirectory
-        remaining_files = os.listdir(subdir)
-        self.assertEqual(remaining_files, ['target.txt'],
-                        f"Only target.txt should remain in subdir, found: {remaining_files}")
+    @unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+    def test_symlink_preserved_with_lock(self):
+        """Test that symlinks are preserved with locking and temp files created in target directory."""
+        def write(path, content):
+            with atomic_write_lock(path) as f:
+                f.write(content)
+            return f.name
+        self._assert_preserves_symlink(write)
 
     def test_reject_directory(self):
         """Test that atomic_write_lock rejects directories."""
         # Create a directory
         dir_path = os.path.join(self.test_dir, 'testdir')
         os.makedirs(dir_path)
+        self.addCleanup(shutil.rmtree, dir_path)
 
         # Should raise RuntimeError for directory
         with self.assertRaises(RuntimeError) as context:
@@ -963,85 +1555,52 @@ class TestAtomicWriteLock(unittest.TestCase):
 
         self.assertIn('Works only on files', str(context.exception))
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Unix socket test requires Unix-like system")
-    def test_reject_unix_socket(self):
-        """Test that atomic_write_lock rejects Unix sockets."""
-        import socket
-
-        # Create a Unix socket
-        socket_path = os.path.join(self.test_dir, 'test.sock')
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            try:
-                sock.bind(socket_path)
-            except PermissionError as exc:
-                self.skipTest(f"Cannot create Unix socket in test dir: {exc}")
+    def test_reject_directory_without_waiting_for_lock(self):
+        """Test that atomic_write_lock rejects directories before taking the lock."""
+        dir_path = os.path.join(self.test_dir, 'testdir')
+        os.makedirs(dir_path)
+        self.addCleanup(shutil.rmtree, dir_path)
 
-            # Should raise RuntimeError for socket
-            with self.assertRaises(RuntimeError) as context:
-                with atomic_write_lock(socket_path) as f:
+        # While the lock is held elsewhere, rejection must not time out
+        with mylockfile(dir_path):
+            with self.assertRaises(RuntimeError):
+                with atomic_write_lock(dir_path, lock_timeout=0.1) as f:
                     f.write('should not work')
 
-            self.assertIn('Works only on files', str(context.exception))
-
-        finally:
-            sock.close()
-            if os.path.exists(socket_path):
-                os.unlink(socket_path)
-
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_mode_w(self):
-        """Test that atomic_write_lock preserves file permissions with mode='w'."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'w') as f:
-            f.write('initial content')
-
-        # Set specific permissions (e.g., 0o644 - rw-r--r--)
-        os.chmod(self.test_file, 0o644)
-        original_mode = os.stat(self.test_file).st_mode
-
-        # Write using atomic_write_lock with mode='w'
-        with atomic_write_lock(self.test_file, mode='w') as f:
-            f.write('updated content')
-
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
-
-    @unittest.skipIf(sys.platform.startswith('win'), "File permissions test requires Unix-like system")
-    def test_preserves_permissions_mode_a(self):
-        """Test that atomic_write_lock preserves file permissions with mode='a'."""
-        # Create a file with specific permissions
-        with open(self.test_file, 'w') as f:
-            f.write('initial content\n')
+    @unittest.skipIf(IS_WINDOWS, "Unix socket test requires Unix-like system")
+    def test_reject_unix_socket(self):
+        """Test that atomic_write_lock rejects Unix sockets."""
+        socket_path = self.get_unix_socket_path()
 
-        # Set specific permissions (e.g., 0o600 - rw-------)
-        os.chmod(self.test_file, 0o600)
-        original_mode = os.stat(self.test_file).st_mode
+        # Should raise RuntimeError for socket
+        with self.assertRaises(RuntimeError) as context:
+            with atomic_write_lock(socket_path) as f:
+                f.write('should not work')
 
-        # Write using atomic_write_lock with mode='a' (uses copy path)
-        with atomic_write_lock(self.test_file, mode='a') as f:
-            f.write('appended content\n')
+        self.assertIn('Works only on files', str(context.exception))
 
-        # Check that permissions are preserved
-        new_mode = os.stat(self.test_file).st_mode
-        self.assertEqual(original_mode, new_mode,
-                        f"File permissions changed from {oct(original_mode)} to {oct(new_mode)}")
+    @unittest.skipIf(IS_WINDOWS, "File permissions test requires Unix-like system")
+    def test_preserves_permissions(self):
+        """Test that atomic_write_lock preserves file permissions with mode='w' and mode='a'."""
+        def write_fn(path, mode, content):
+            with atomic_write_lock(path, mode=mode) as f:
+                f.write(content)
 
-        # Verify content was actually appended
-        with open(self.test_file, 'r') as f:
-            content = f.read()
-            self.assertIn('initial content', content)
-            self.assertIn('appended content', content)
+        # mode='a' goes through the copy path
+        self._assert_preserves_permissions(write_fn, [
+            ('w', 0o644, 'updated content'),
+            ('a', 0o600, 'appended content\n'),
+        ])
 
-    @unittest.skipIf(sys.platform.startswith('win'), "Requires Unix-style symlinks and permissions")
+    @unittest.skipIf(IS_WINDOWS, "Requires Unix-style symlinks and permissions")
     def test_modes_through_readonly_symlink(self):
         """Test various modes when writing through a symlink inside a read-only directory."""
         ro_dir = os.path.join(self.test_dir, 'RO')
         rw_dir = os.path.join(self.test_dir, 'RW')
         os.makedirs(ro_dir)
         os.makedirs(rw_dir)
+        self.addCleanup(shutil.rmtree, ro_dir)
+        self.addCleanup(shutil.rmtree, rw_dir)
 
         symlink_path = os.path.join(ro_dir, 'symlink')
         target_path = os.path.join(rw_dir, 'afile')
@@ -1050,8 +1609,10 @@ class TestAtomicWriteLock(unittest.TestCase):
 
         os.chmod(ro_dir, 0o555)
         try:
-            if os.path.exists(target_path):
+            try:
                 os.unlink(target_path)
+            except FileNotFoundError:
+                pass
 
             # Mode 'w' should create the target even though the symlink's parent is read-only.
             with atomic_write_lock(symlink_path, mode='w') as f:
@@ -1173,6 +1734,55 @@ class TestModeBehavior(unittest.TestCase):
                 with self.assertRaises(ValueError):
                     open_modes_behaviour(mode)
 
+    def test_behavior_is_shared_and_immutable(self):
+        """The same mode gives the same object, that cannot be modified."""
+        behavior = open_modes_behaviour('w')
+        self.assertIs(open_modes_behaviour('w'), behavior)
+        with self.assertRaises(AttributeError):
+            behavior.append = True
+
+
+class TestAbspath(unittest.TestCase):
+    """Test the _abspath helper."""
+
+    def test_same_as_os_path_abspath(self):
+        """Relative, normalized and unnormalized absolute paths give what os.path.abspath gives."""
+        root = os.path.abspath(os.sep)
+        paths = ['file.txt', os.path.join('.', 'dir', '..', 'file.txt'), root,
+                 os.path.join(root, 'dir', 'file.txt'),
+                 os.path.join(root, 'dir', '.', 'file.txt'),
+                 os.path.join(root, 'dir', '..', 'file.txt'),
+                 os.path.join(root, 'dir', '.hidden'),
+                 os.path.join(root, 'dir', '') + os.sep + 'file.txt',
+                 os.path.join(root, 'dir', '')]
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(wrap_lockfile._abspath(path), os.path.abspath(path))
+
+
+
+@unittest.skipIf(IS_WINDOWS, "Symlink test requires Unix-like system")
+class TestStatAndResolve(unittest.TestCase):
+    """Test the _stat_and_resolve helper."""
+
+    def test_same_as_separate_calls(self):
+        """Files, symlinks, dangling symlinks and missing paths give what the two helpers give."""
+        with tempfile.TemporaryDirectory() as d:
+            target = os.path.join(d, 'target.txt')
+            with open(target, 'w') as f:
+                f.write('content')
+            link = os.path.join(d, 'link.txt')
+            os.symlink('target.txt', link)
+            dangling = os.path.join(d, 'dangling.txt')
+            os.symlink('missing.txt', dangling)
+            for path in (target, link, dangling, os.path.join(d, 'missing.txt')):
+                with self.subTest(path=path):
+                    st, target_name = wrap_lockfile._stat_and_resolve(path)
+                    expected = wrap_lockfile._stat_if_exists(path)
+                    self.assertEqual(st is None, expected is None)
+                    if st is not None:
+                        self.assertEqual((st.st_dev, st.st_ino), (expected.st_dev, expected.st_ino))
+                    self.assertEqual(target_name, wrap_lockfile._resolve_symlink(path))
 
 if __name__ == '__main__':
     unittest.main()
@@ -9,45 +9,42 @@ Provides a unified interface for file locking that:
 
 import os
 import sys
+import atexit
 import errno
 import tempfile
 import shutil
 import time
 import contextlib
-import subprocess
+import dataclasses
 import re
+import random
+import signal
+import stat
+import itertools
+import numbers
+import codecs
+import locale
+import threading
 from threading import local
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 logger = logging.getLogger(__name__)
 
-CP_HAS_REFLINK = None
-
-try:
-    if sys.platform.startswith('linux'):
-        # Check for GNU coreutils --reflink support
-        p = subprocess.run(["cp", "--help"], capture_output=True, text=True)
-        output = p.stdout + p.stderr
-        if '--reflink' in output:
-            CP_HAS_REFLINK = '--reflink=auto'
-    elif sys.platform.startswith('darwin'):
-        # macOS uses -c for APFS clonefile (macOS 10.13+)
-        p = subprocess.run(["cp", "--help"], capture_output=True, text=True)
-        output = p.stdout + p.stderr
-        if '-c' in output or 'clonefile' in output:
-            CP_HAS_REFLINK = '-c'
-    # FreeBSD, OpenBSD, NetBSD, and other BSDs don't have direct cp equivalents
-    # so CP_HAS_REFLINK remains None
-    # Similarly for MS Windows
-except Exception as e:
-    sys.stderr.write('(wrap_lockfile failed when detecting copy-on-write support)\n')
-
 
 ####################### fallback exceptions and implementations
 
 class LockTimeout(Exception):
-    """Exception raised when lock acquisition times out."""
-    pass
+    """Exception raised when lock acquisition times out.
+
+    The fallbacks raise it as LockTimeout(filename, elapsed), and the
+    message is formatted only when the exception is displayed.
+    """
+
+    def __str__(self):
+        if len(self.args) == 2 and isinstance(self.args[1], numbers.Real):
+            return "Timeout waiting for lock on %s after %.1f seconds" % self.args
+        return super().__str__()
 
 
 class AlreadyLocked(Exception):
@@ -56,8 +53,21 @@ class AlreadyLocked(Exception):
 
 
 class LockFailed(Exception):
-    """Exception raised when lock acquisition fails."""
-    pass
+    """Exception raised when lock acquisition fails.
+
+    The fallbacks raise it as LockFailed(error), with the OSError that
+    made the lock fail, and the message is formatted only when the
+    exception is displayed.
+    """
+
+    def __str__(self):
+        if len(self.args) == 1 and isinstance(self.args[0], OSError):
+            return "Failed to acquire lock: %s" % self.args[0]
+        return super().__str__()
+
+
+# Exceptions raised by the fallback implementations, built once and shared
+_FALLBACK_LOCK_EXCEPTIONS = (LockTimeout, AlreadyLocked, LockFailed)
 
 
 # Default: no-op implementations
@@ -65,137 +75,416 @@ def mylockfile(fil, timeout=None):
     """Fake lockfile context - does nothing."""
     return contextlib.nullcontext()
 
+_noop_lockfile = mylockfile
 myLockTimeout = LockTimeout
 mylockfile_exceptions = ()
 
+
+# Polling of the fallback file locks when a timeout is given: the delays
+# between attempts follow this schedule, starting small, as locks are
+# usually held briefly, and then repeating the last one; a random jitter
+# of up to a tenth of the delay keeps waiting processes from retrying in
+# lockstep
+_LOCK_BACKOFF_SCHEDULE = (0.0001, 0.0003, 0.001, 0.002, 0.005)
+_LOCK_POLL_JITTER = 0.1
+
+
+# In-process locks in front of the fallback file locks: threads of this
+# process wait on a threading.Lock, that wakes them up as soon as it is
+# released, and only the thread holding it competes with other processes
+# for the file lock. The threads also share the open lock file, so that
+# it is not reopened at every handoff. Entries are
+# [threading.Lock, number of users, descriptor of the shared lock file or None];
+# they are reference counted and removed when unused.
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+# Incremented when a child process forgets the registry of its parent, so
+# that locks held at fork time are not released in the new registry
+_path_locks_generation = 0
+
+# Descriptors of lock files that no thread is using, kept open (and the
+# files kept on disk) for the next acquisition of the same path, least
+# recently used first; guarded by _path_locks_guard
+_IDLE_LOCK_FDS_MAX = 64
+_idle_lock_fds = {}
+
+
+def _close_quietly(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
+def _keep_idle_lock_fd(path, fd):
+    """Keep the unlocked descriptor fd of the lock file path for reuse; call with _path_locks_guard held."""
+    _idle_lock_fds[path] = fd
+    if len(_idle_lock_fds) > _IDLE_LOCK_FDS_MAX:
+        _close_quietly(_idle_lock_fds.pop(next(iter(_idle_lock_fds))))
+
+
+def _close_idle_lock_fds():
+    """Close all the idle lock file descriptors."""
+    with _path_locks_guard:
+        while _idle_lock_fds:
+            _close_quietly(_idle_lock_fds.popitem()[1])
+
+
+def _forget_path_locks_after_fork():
+    """Start the child process with an empty registry of path locks.
+
+    The shared and idle descriptors share their open file descriptions, and
+    so their flock locks, with the parent, and are closed. The in-process
+    locks and the guard are replaced: another thread of the parent may have
+    held them at fork time, and would never release them in the child.
+    """
+    global _path_locks, _path_locks_guard, _path_locks_generation
+    for entry in _path_locks.values():
+        if entry[2] is not None:
+            _close_quietly(entry[2])
+    while _idle_lock_fds:
+        _close_quietly(_idle_lock_fds.popitem()[1])
+    _path_locks = {}
+    _path_locks_guard = threading.Lock()
+    _path_locks_generation += 1
+
+
+atexit.register(_close_idle_lock_fds)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_path_locks_after_fork)
+
+
+def _drop_path_lock(path, release_file):
+    """Drop one reference to the in-process lock for path.
+
+    release_file(lock_file, last) is called, if there is a shared lock file,
+    while no other thread can take a reference; last tells whether this
+    was the last user, so that the file must be closed or kept idle.
+    """
+    with _path_locks_guard:
+        entry = _path_locks[path]
+        entry[1] -= 1
+        last = entry[1] == 0
+        if last:
+            del _path_locks[path]
+        if entry[2] is not None:
+            release_file(entry[2], last)
+    return entry
+
+
+def _lock_wait_timeout(timeout):
+    """Return timeout as accepted by threading.Lock.acquire: -1 to wait forever, else clamped."""
+    if timeout is None or timeout == float('inf'):
+        return -1
+    return min(max(timeout, 0), threading.TIMEOUT_MAX)
+
+
+def _acquire_path_lock(path, timeout, release_file):
+    """Acquire the in-process lock for path.
+
+    Returns:
+        list: the registry entry, or None on timeout
+    """
+    with _path_locks_guard:
+        entry = _path_locks.get(path)
+        if entry is None:
+            entry = _path_locks[path] = [threading.Lock(), 0, _idle_lock_fds.pop(path, None)]
+        entry[1] += 1
+    if entry[0].acquire(timeout=_lock_wait_timeout(timeout)):
+        return entry
+    _drop_path_lock(path, release_file)
+    return None
+
+
+def _release_path_lock(path, release_file):
+    """Release the in-process lock for path acquired by _acquire_path_lock."""
+    _drop_path_lock(path, release_file)[0].release()
+
+
+class _PlatformFileLock(local):
+    """
+    Base of the fallback file locks, context managers providing exclusive
+    locking of filename + '.lock'.
+
+    Threads of the process first take the in-process lock of the path, then
+    the one holding it locks the shared lock file. Subclasses implement the
+    platform primitives _lock (blocking), _try_lock (raising OSError with an
+    errno in _busy_errnos when the lock is held elsewhere) and _unlock.
+
+    The lock file is not removed on release, and if _keep_idle_fd its
+    descriptor is kept open for the next acquisition, up to
+    _IDLE_LOCK_FDS_MAX paths: removing it would let a waiter lock the
+    removed file while a newcomer locks a new one with the same name.
+    """
+
+    # flags used to open the lock file
+    _open_flags = os.O_WRONLY | os.O_CREAT
+    # whether the last user keeps the lock file open for reuse
+    _keep_idle_fd = True
+    # errors of _try_lock meaning that the lock is held by someone else
+    _busy_errnos = (errno.EWOULDBLOCK, errno.EACCES)
+
+    def __init__(self, filename, timeout=None):
+        """
+        Initialize the file lock.
+
+        Args:
+            filename (str): Path to file to lock (can be the file itself
+                           or a separate .lock file)
+            timeout (float): Maximum time to wait for lock in seconds
+                           (None = wait indefinitely)
+        """
+        self.filename = filename
+        self.lockfile = filename + '.lock'
+        self._lock_key = _abspath(self.lockfile)
+        self.timeout = timeout
+        self.fd = None
+        # nested __enter__ calls of the thread holding the lock
+        self._depth = 0
+        # _path_locks_generation when the lock was acquired
+        self._generation = None
+
+    def __enter__(self):
+        """Acquire the lock, or enter it again if this thread already holds it."""
+        if self.fd is not None:
+            self._depth += 1
+            return self
+        start_time = time.monotonic()
+        entry = _acquire_path_lock(self._lock_key, self.timeout, self._discard_lock_file)
+        if entry is None:
+            raise LockTimeout(self.filename, time.monotonic() - start_time)
+        try:
+            while True:
+                if entry[2] is None:
+                    # Create/open lock file
+                    entry[2] = os.open(self.lockfile, self._open_flags, 0o644)
+                self._acquire_file_lock(entry[2], start_time)
+                if self._is_current(entry[2]):
+                    break
+                # Another process removed the lock file after it was
+                # opened, so locking it excludes nobody: open it again
+                os.close(entry[2])
+                entry[2] = None
+        except BaseException:
+            _release_path_lock(self._lock_key, self._discard_lock_file)
+            raise
+        self.fd = entry[2]
+        self._generation = _path_locks_generation
+        return self
+
+    def _is_current(self, fd):
+        """Tell whether fd is still the file at the lock file path."""
+        return True
+
+    def _acquire_file_lock(self, fd, start_time):
+        """Acquire the lock on the open lock file fd, once the in-process lock is held."""
+        if self.timeout is None:
+            # Wait indefinitely for lock
+            try:
+                self._lock(fd)
+            except IOError as e:
+                if e.errno in self._busy_errnos:
+                    raise AlreadyLocked("File is already locked: %s" % self.filename)
+                else:
+                    raise LockFailed(e)
+        else:
+            # Try to acquire lock with timeout, polling with the backoff schedule
+            deadline = start_time + self.timeout
+            attempt, last_attempt = 0, len(_LOCK_BACKOFF_SCHEDULE) - 1
+            # Look up once what the loop calls on every attempt
+            try_lock, busy_errnos = self._try_lock, self._busy_errnos
+            monotonic, sleep, rand = time.monotonic, time.sleep, random.random
+            while True:
+                try:
+                    # Try non-blocking lock
+                    try_lock(fd)
+                    break  # Lock acquired
+                except IOError as e:
+                    if e.errno in busy_errnos:
+                        # Lock is held by someone else
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            raise LockTimeout(self.filename, self.timeout - remaining)
+                        if self._wait_for_lock(fd, remaining):
+                            break
+                        # Wait a bit, but not past the deadline, and retry
+                        delay = _LOCK_BACKOFF_SCHEDULE[attempt]
+                        sleep(min(delay * (1 + _LOCK_POLL_JITTER * rand()), remaining))
+                        if attempt < last_attempt:
+                            attempt += 1
+                    else:
+                        raise LockFailed(e)
+
+    def _release_lock_file(self, fd, last):
+        """Release the lock held on fd; the last user keeps the lock file open for reuse, or closes it."""
+        try:
+            self._unlock(fd)
+        except Exception:
+            # Closing releases the lock anyway
+            if last:
+                _close_quietly(fd)
+            return
+        if last:
+            if self._keep_idle_fd:
+                _keep_idle_lock_fd(self._lock_key, fd)
+            else:
+                _close_quietly(fd)
+
+    def _discard_lock_file(self, fd, last):
+        """Drop a reference to fd, that may be locked if acquiring failed late."""
+        if last:
+            self._release_lock_file(fd, last)
+
+    def _wait_for_lock(self, fd, remaining):
+        """Block until the lock is acquired, for at most remaining seconds.
+
+        Returns:
+            bool: True if acquired, False if blocking is not possible and
+                  the caller must poll
+        """
+        return False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Release the lock, when the outermost __enter__ is exited."""
+        if self._depth:
+            self._depth -= 1
+        elif self.fd is not None:
+            self.fd = None
+            # A lock held when the process forked was forgotten by the child
+            if self._generation == _path_locks_generation:
+                _release_path_lock(self._lock_key, self._release_lock_file)
+
+        return False  # Don't suppress exceptions
+
+    def close(self):
+        """Close the lock file descriptor kept open for the path, if it is idle."""
+        with _path_locks_guard:
+            fd = _idle_lock_fds.pop(self._lock_key, None)
+        if fd is not None:
+            _close_quietly(fd)
+
+
 ############################# use lockfile
 
 # Try to import the lockfile library
 try:
     import lockfile
-    # Use the real lockfile library
-    mylockfile = lockfile.FileLock
-    myLockTimeout = lockfile.LockTimeout
-    mylockfile_exceptions = (
-        lockfile.LockTimeout,
-        lockfile.AlreadyLocked,
-        lockfile.LockFailed
-    )
 except ImportError:
     lockfile = None
 
+# Only the fallback of the current platform is imported
+_IS_WINDOWS = sys.platform.startswith('win')
+
 ########################## use fcntl
 
 # will use fcntl for fallback implementation (Unix/Linux only)
-try:
-    import fcntl
-    HAVE_FCNTL = True
-except ImportError:
-    fcntl = None
-    HAVE_FCNTL = False
+fcntl = None
+HAVE_FCNTL = False
+if not _IS_WINDOWS:
+    try:
+        import fcntl
+        HAVE_FCNTL = True
+    except ImportError:
+        pass
 
 
 # Fallback: implement our own using fcntl.flock if available
 if HAVE_FCNTL:
-    import time
 
-    class FcntlFileLock(local):
+    class _LockAlarm(Exception):
+        """Raised by the SIGALRM handler to interrupt a blocking flock."""
+        pass
+
+    def _lock_alarm_handler(signum, frame):
+        raise _LockAlarm()
+
+    def _lock_alarm_available():
+        """Tell whether a blocking flock can be interrupted by SIGALRM.
+
+        Signal handlers run in the main thread only, and SIGALRM and the
+        real-time interval timer must not be in use by the application.
+        The timer raises a process-directed SIGALRM, that the kernel may
+        deliver to any thread: with other threads running, the flock of
+        the main thread might not be interrupted, so they poll instead.
+        """
+        return (hasattr(signal, 'setitimer')
+                and threading.current_thread() is threading.main_thread()
+                and threading.active_count() == 1
+                and signal.getsignal(signal.SIGALRM) == signal.SIG_DFL
+                and signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0))
+
+    class FcntlFileLock(_PlatformFileLock):
         """
         File locking implementation using fcntl.flock.
 
         This is a context manager that provides exclusive file locking
         on Unix-like systems using the flock system call.
-        """
 
-        def __init__(self, filename, timeout=None):
-            """
-            Initialize the file lock.
-
-            Args:
-                filename (str): Path to file to lock (can be the file itself
-                               or a separate .lock file)
-                timeout (float): Maximum time to wait for lock in seconds
-                               (None = wait indefinitely)
-            """
-            self.filename = filename
-            self.lockfile = filename + '.lock'
-            self.timeout = timeout
-            self.fd = None
+        flock locks belong to the open file description, as OFD locks do:
+        closing another descriptor of the lock file does not release them,
+        unlike POSIX fcntl/lockf locks, that belong to the process. On NFS,
+        Linux emulates flock with byte-range locks on the server.
+        """
 
-        def __enter__(self):
-            """Acquire the lock."""
-            # Create/open lock file
-            self.fd = open(self.lockfile, 'w')
+        def _lock(self, fd):
+            fcntl.flock(fd, fcntl.LOCK_EX)
 
-            start_time = time.time()
+        def _try_lock(self, fd):
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
-            if self.timeout is None:
-                # Wait indefinitely for lock
-                try:
-                    fcntl.flock(self.fd.fileno(), fcntl.LOCK_EX)
-                except IOError as e:
-                    self.fd.close()
-                    self.fd = None
-                    if e.errno == errno.EWOULDBLOCK:
-                        raise AlreadyLocked("File is already locked: %s" % self.filename)
-                    else:
-                        raise LockFailed("Failed to acquire lock: %s" % e)
-            else:
-                # Try to acquire lock with timeout
-                while True:
-                    try:
-                        # Try non-blocking lock
-                        fcntl.flock(self.fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                        break  # Lock acquired
-                    except IOError as e:
-                        if e.errno in (errno.EWOULDBLOCK, errno.EACCES):
-                            # Lock is held by someone else
-                            elapsed = time.time() - start_time
-                            if elapsed >= self.timeout:
-                                self.fd.close()
-                                self.fd = None
-                                raise LockTimeout(
-                                    "Timeout waiting for lock on %s after %.1f seconds"
-                                    % (self.filename, elapsed)
-                                )
-                            # Wait a bit and retry
-                            time.sleep(0.01)
-                        else:
-                            self.fd.close()
-                            self.fd = None
-                            raise LockFailed("Failed to acquire lock: %s" % e)
+        def _is_current(self, fd):
+            """Tell whether fd is still the file at the lock file path."""
+            st = os.fstat(fd)
+            try:
+                current = os.stat(self.lockfile)
+            except FileNotFoundError:
+                return False
+            return (st.st_dev, st.st_ino) == (current.st_dev, current.st_ino)
 
-            return self
+        def _wait_for_lock(self, fd, remaining):
+            """Wait with a blocking flock, to be woken as soon as the lock is released.
 
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            """Release the lock."""
-            if self.fd:
+            The flock is interrupted by SIGALRM after remaining seconds, at
+            most threading.TIMEOUT_MAX; this is only possible when
+            _lock_alarm_available().
+            """
+            if not _lock_alarm_available():
+                return False
+            acquired = False
+            previous_handler = signal.signal(signal.SIGALRM, _lock_alarm_handler)
+            try:
                 try:
-                    fcntl.flock(self.fd.fileno(), fcntl.LOCK_UN)
-                except Exception:
-                    pass  # Ignore errors during unlock
+                    signal.setitimer(signal.ITIMER_REAL, min(remaining, threading.TIMEOUT_MAX))
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    acquired = True
                 finally:
-                    self.fd.close()
-                    self.fd = None
-                    # Clean up lock file
-                    try:
-                        os.unlink(self.lockfile)
-                    except Exception:
-                        pass  # Ignore errors during cleanup
-
-            return False  # Don't suppress exceptions
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            except _LockAlarm:
+                # The alarm may also fire just after flock returned
+                if not acquired:
+                    raise LockTimeout(self.filename, self.timeout)
+            except IOError as e:
+                raise LockFailed(e)
+            finally:
+                signal.signal(signal.SIGALRM, previous_handler)
+            return True
+
+        def _unlock(self, fd):
+            fcntl.flock(fd, fcntl.LOCK_UN)
 
 ######################################## mscvrt
 
-try:
-    import msvcrt
-except ImportError:
-    msvcrt = None
+msvcrt = None
+if _IS_WINDOWS:
+    try:
+        import msvcrt
+    except ImportError:
+        pass
 
 
-if msvcrt and sys.platform.startswith('win'):
+if msvcrt:
     # On Windows, use msvcrt.locking
-    class msvcrtFileLock(local):
+    class msvcrtFileLock(_PlatformFileLock):
         """
         File locking implementation using msvcrt.locking.
 
@@ -203,143 +492,85 @@ if msvcrt and sys.platform.startswith('win'):
         on Windows systems using the msvcrt locking mechanism.
         """
 
-        def __init__(self, filename, timeout=None):
-            """
-            Initialize the file lock.
+        _open_flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        _busy_errnos = (errno.EACCES, errno.EAGAIN)
+        # os.open does not share delete access on Windows: an idle open
+        # descriptor would prevent removing the lock file or its directory
+        _keep_idle_fd = False
 
-            Args:
-                filename (str): Path to file to lock (can be the file itself
-                               or a separate .lock file)
-                timeout (float): Maximum time to wait for lock in seconds
-                               (None = wait indefinitely)
-            """
-            self.filename = filename
-            self.lockfile = filename + '.lock'
-            self.timeout = timeout
-            self.fd = None
+        def _lock(self, fd):
+            # Use blocking lock (LK_LOCK)
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
 
-        def __enter__(self):
-            """Acquire the lock."""
-            # Create/open lock file
-            self.fd = open(self.lockfile, 'w')
+        def _try_lock(self, fd):
+            # Non-blocking lock (LK_NBLCK)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
 
-            start_time = time.time()
-
-            if self.timeout is None:
-                # Wait indefinitely for lock
-                try:
-                    # Use blocking lock (LK_LOCK)
-                    msvcrt.locking(self.fd.fileno(), msvcrt.LK_LOCK, 1)
-                except IOError as e:
-                    self.fd.close()
-                    self.fd = None
-                    if e.errno == errno.EACCES:
-                        raise AlreadyLocked("File is already locked: %s" % self.filename)
-                    else:
-                        raise LockFailed("Failed to acquire lock: %s" % e)
-            else:
-                # Try to acquire lock with timeout
-                while True:
-                    try:
-                        # Try non-blocking lock (LK_NBLCK)
-                        msvcrt.locking(self.fd.fileno(), msvcrt.LK_NBLCK, 1)
-                        break  # Lock acquired
-                    except IOError as e:
-                        if e.errno in (errno.EACCES, errno.EAGAIN):
-                            # Lock is held by someone else
-                            elapsed = time.time() - start_time
-                            if elapsed >= self.timeout:
-                                self.fd.close()
-                                self.fd = None
-                                raise LockTimeout(
-                                    "Timeout waiting for lock on %s after %.1f seconds"
-                                    % (self.filename, elapsed)
-                                )
-                            # Wait a bit and retry
-                            time.sleep(0.01)
-                        else:
-                            self.fd.close()
-                            self.fd = None
-                            raise LockFailed("Failed to acquire lock: %s" % e)
-
-            return self
-
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            """Release the lock."""
-            if self.fd:
-                try:
-                    # Unlock the file (LK_UNLCK)
-                    msvcrt.locking(self.fd.fileno(), msvcrt.LK_UNLCK, 1)
-                except Exception:
-                    pass  # Ignore errors during unlock
-                finally:
-                    self.fd.close()
-                    self.fd = None
-                    # Clean up lock file
-                    try:
-                        os.unlink(self.lockfile)
-                    except Exception:
-                        pass  # Ignore errors during cleanup
-
-            return False  # Don't suppress exceptions
+        def _unlock(self, fd):
+            # Unlock the file (LK_UNLCK)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
 
 
 ######################################### chose implementation
 
-if lockfile is None:
+def _select_lock_impl():
+    """Choose the lock implementation.
+
+    Returns:
+        tuple: (lock class, its timeout exception, tuple of its exceptions)
+    """
+    if lockfile is not None:
+        # Use the real lockfile library
+        return (lockfile.FileLock, lockfile.LockTimeout,
+                (lockfile.LockTimeout, lockfile.AlreadyLocked, lockfile.LockFailed))
     # No lockfile library available, use platform-specific fallback
-    if msvcrt and sys.platform.startswith('win'):
+    if msvcrt:
         # Use Windows-specific msvcrt implementation
-        mylockfile = msvcrtFileLock
-        myLockTimeout = LockTimeout
-        mylockfile_exceptions = (LockTimeout, AlreadyLocked, LockFailed)
-    elif HAVE_FCNTL:
+        return msvcrtFileLock, LockTimeout, _FALLBACK_LOCK_EXCEPTIONS
+    if HAVE_FCNTL:
         # Use Unix/Linux fcntl-based implementation
-        mylockfile = FcntlFileLock
-        myLockTimeout = LockTimeout
-        mylockfile_exceptions = (LockTimeout, AlreadyLocked, LockFailed)
-    else:
-        # No locking available - keep no-op implementation
-        # mylockfile, myLockTimeout, mylockfile_exceptions already set above
-        pass
+        return FcntlFileLock, LockTimeout, _FALLBACK_LOCK_EXCEPTIONS
+    # No locking available - keep no-op implementation
+    return mylockfile, myLockTimeout, mylockfile_exceptions
+
+
+mylockfile, myLockTimeout, mylockfile_exceptions = _select_lock_impl()
+
+# Without any locking, the writers skip the no-op lock altogether
+_LOCK_IS_NOOP = mylockfile is _noop_lockfile
 
 ########################################## file mode for opening
+@dataclasses.dataclass(frozen=True, repr=False)
 class ModeBehavior:
-    """Represents the behavior characteristics of a file opening mode."""
-    
-    def __init__(self, read=False, write=False, append=False, truncate=False, 
-                 create=False, must_exist=False, binary=False, exclusive=False):
-        self.read = read
-        self.write = write
-        self.append = append
-        self.truncate = truncate
-        self.create = create
-        self.must_exist = must_exist
-        self.binary = binary
-        self.exclusive = exclusive
-    
+    """Represents the behavior characteristics of a file opening mode.
+
+    Instances are immutable, since open_modes_behaviour shares them among
+    all the callers asking for the same mode.
+    """
+    read: bool = False
+    write: bool = False
+    append: bool = False
+    truncate: bool = False
+    create: bool = False
+    must_exist: bool = False
+    binary: bool = False
+    exclusive: bool = False
+
     @property
     def text(self):
         return not self.binary
     
     def __repr__(self):
-        attrs = [f"{k}={v}" for k, v in self.__dict__.items() if v]
+        attrs = [f"{f.name}={getattr(self, f.name)}" for f in dataclasses.fields(self)
+                 if getattr(self, f.name)]
         return f"ModeBehavior({', '.join(attrs)})"
 
 
-def open_modes_behaviour(mode):
-    """
-    Returns the behavior characteristics of Python file opening modes.
-    
-    Args:
-        mode (str): File opening mode (e.g., 'r', 'w', 'w+', 'rb', etc.)
-    
-    Returns:
-        ModeBehavior: Object with boolean attributes for mode behaviors
-    
-    Raises:
-        ValueError: If mode is invalid
-    """
+_ALLOWED_BASE_MODES = ('r', 'r+', 'w', 'w+', 'a', 'a+', 'x', 'x+')
+
+
+def _parse_mode(mode):
+    """Parse mode into a ModeBehavior; see open_modes_behaviour."""
     # Extract binary/text and base mode
     binary = 'b' in mode
     text_explicit = 't' in mode
@@ -349,29 +580,498 @@ def open_modes_behaviour(mode):
     if binary and text_explicit:
         raise ValueError(f"Invalid file mode: '{mode}'. Cannot specify both 'b' and 't'")
     
-    allowed_modes = ('r', 'r+', 'w', 'w+', 'a', 'a+', 'x', 'x+')
+    allowed_modes = _ALLOWED_BASE_MODES
     if base_mode not in allowed_modes:
         raise ValueError(f"Invalid file mode: '{mode}'. Valid modes are: {', '.join(allowed_modes)} (with optional 'b' or 't')")
     
     
-    # Initialize behavior object
-    mb = ModeBehavior(binary=binary)
-    
     # Set behaviors based on mode
-    mb.read = '+' in base_mode or base_mode == 'r'
-    mb.write = base_mode != 'r'
-    mb.append = 'a' in base_mode
-    mb.truncate = 'w' in base_mode
-    mb.create = base_mode != 'r' and base_mode != 'r+'
-    mb.must_exist = 'r' in base_mode
-    mb.exclusive = 'x' in base_mode
+    return ModeBehavior(
+        read='+' in base_mode or base_mode == 'r',
+        write=base_mode != 'r',
+        append='a' in base_mode,
+        truncate='w' in base_mode,
+        create=base_mode != 'r' and base_mode != 'r+',
+        must_exist='r' in base_mode,
+        binary=binary,
+        exclusive='x' in base_mode,
+    )
+
+
+# Behaviors of all the usual spellings of the valid modes, with 'b' or 't'
+# in any position, computed once at import
+_MODE_TABLE = {
+    base[:i] + flag + base[i:]: None
+    for base in _ALLOWED_BASE_MODES
+    for flag in ('', 'b', 't')
+    for i in range(len(base) + 1)
+}
+for _mode in _MODE_TABLE:
+    _MODE_TABLE[_mode] = _parse_mode(_mode)
+del _mode
+
+
+def open_modes_behaviour(mode):
+    """
+    Returns the behavior characteristics of Python file opening modes.
+    
+    Args:
+        mode (str): File opening mode (e.g., 'r', 'w', 'w+', 'rb', etc.)
+    
+    Usual modes are looked up in a table computed at import, so the same
+    object is returned for the same mode; other spellings are parsed.
+
+    Returns:
+        ModeBehavior: Immutable object with boolean attributes for mode behaviors
     
-    return mb
+    Raises:
+        ValueError: If mode is invalid
+    """
+    try:
+        return _MODE_TABLE[mode]
+    except KeyError:
+        return _parse_mode(mode)
+
+
+#################################### paths
+
+_SEP_DOT = os.sep + '.'
+_SEP_SEP = os.sep + os.sep
+
+
+def _abspath(path):
+    """Same as os.path.abspath, but return absolute paths that are already normalized as they are."""
+    if (isinstance(path, str) and not os.altsep and os.path.isabs(path)
+            and _SEP_DOT not in path and _SEP_SEP not in path and not path.endswith(os.sep)):
+        return path
+    return os.path.abspath(path)
+
+
+def _stat_if_exists(path):
+    """Return os.stat(path), or None where os.path.exists(path) would be False."""
+    try:
+        return os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+
+#################################### symlinks
+
+def _read_symlink(filename):
+    """Return the path the symlink filename points to.
+
+    The link is read every time: a cache keyed on its lstat could miss a
+    link recreated with the same inode, within the timestamp granularity.
+    """
+    readlink = os.readlink(filename)
+    if os.path.isabs(readlink):
+        return readlink
+    return os.path.join(os.path.dirname(filename), readlink)
+
+
+def _resolve_symlink(filename):
+    """Return the file that filename points to if it is a symlink, else filename.
+
+    Only one level of symlink is followed: the writers replace that file,
+    and so preserve the symlink itself.
+    """
+    try:
+        st = os.lstat(filename)
+    except OSError:
+        return filename
+    if not stat.S_ISLNK(st.st_mode):
+        return filename
+    return _read_symlink(filename)
+
+
+def _stat_and_resolve(filename):
+    """Return (_stat_if_exists(filename), _resolve_symlink(filename)).
+
+    A file that is not a symlink is looked up only once, by lstat.
+    """
+    try:
+        st = os.lstat(filename)
+    except (OSError, ValueError):
+        return None, filename
+    if not stat.S_ISLNK(st.st_mode):
+        return st, filename
+    target = _read_symlink(filename)
+    return _stat_if_exists(filename), target
+
+
+#################################### copying
+
+# errors of os.copy_file_range meaning that it cannot be used for those files
+_COPY_FILE_RANGE_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP')
+    if hasattr(errno, name))
+
+# errors of os.sendfile meaning that it cannot be used for those files;
+# where the output must be a socket, it fails with ENOTSOCK
+_SENDFILE_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in ('ENOTSOCK', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP')
+    if hasattr(errno, name))
+
+# buffers used to copy files with readv/writev
+_COPY_BUFFER_SIZE = 65536
+_COPY_BUFFER_COUNT = 8
+
+
+def _copy_fd_range(src_fd, dst_fd):
+    """Copy from src_fd to dst_fd with os.copy_file_range, in the kernel."""
+    while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+        pass
+
+
+def _copy_fd_sendfile(src_fd, dst_fd):
+    """Copy from src_fd to dst_fd with os.sendfile, in the kernel."""
+    offset = 0
+    while True:
+        n = os.sendfile(dst_fd, src_fd, offset, 1 << 30)
+        if n == 0:
+            return
+        offset += n
+
+
+def _copy_fd_vectored(src_fd, dst_fd):
+    """Copy from src_fd to dst_fd, reading and writing several buffers per syscall."""
+    views = [memoryview(bytearray(_COPY_BUFFER_SIZE)) for _ in range(_COPY_BUFFER_COUNT)]
+    while True:
+        n = os.readv(src_fd, views)
+        if n == 0:
+            return
+        pending = []
+        for view in views:
+            if n <= 0:
+                break
+            pending.append(view[:n])
+            n -= len(view)
+        while pending:
+            written = os.writev(dst_fd, pending)
+            # drop what was written, writev may stop short
+            while pending and written >= len(pending[0]):
+                written -= len(pending[0])
+                pending.pop(0)
+            if written:
+                pending[0] = pending[0][written:]
+
+
+def _copy_file(src, dst):
+    """Copy the contents and metadata of src to dst, as shutil.copy2 does.
+
+    Where available, os.copy_file_range copies the data in the kernel, and
+    shares the data blocks on copy-on-write filesystems; failing that,
+    os.sendfile copies it in the kernel; otherwise, the data is copied with
+    os.readv/os.writev, or with shutil.copyfileobj.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for name, copy_fd, unsupported in (
+                ('copy_file_range', _copy_fd_range, _COPY_FILE_RANGE_UNSUPPORTED),
+                ('sendfile', _copy_fd_sendfile, _SENDFILE_UNSUPPORTED)):
+            if not hasattr(os, name):
+                continue
+            try:
+                copy_fd(fsrc.fileno(), fdst.fileno())
+                break
+            except OSError as e:
+                if e.errno not in unsupported:
+                    raise
+            # Start over, in case some data was copied before the failure
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        else:
+            if hasattr(os, 'readv'):
+                _copy_fd_vectored(fsrc.fileno(), fdst.fileno())
+            else:
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+#################################### temporary files
+
+# Temporary files are named after the process id and a counter: they are
+# unique in the process, and O_EXCL catches clashes with stale files, so
+# there is no need for the random names of tempfile.mkstemp
+_temp_counter = itertools.count()
+_temp_pid = os.getpid()
+
+
+def _reset_temp_names_after_fork():
+    """Sample the pid again in the child process."""
+    global _temp_pid
+    _temp_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_temp_names_after_fork)
+
+_TEMP_OPEN_FLAGS = (os.O_RDWR | os.O_CREAT | os.O_EXCL
+                    | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+
+
+def _temp_names(dir_name, prefix, suffix):
+    """Yield the candidate names of a temporary file in dir_name, at most TMP_MAX of them."""
+    for _ in range(tempfile.TMP_MAX):
+        yield os.path.join(dir_name, '%s%d.%d%s' % (prefix, _temp_pid, next(_temp_counter), suffix))
+
+
+def _create_temp_file(dir_name, prefix, suffix):
+    """Create a new file in dir_name, readable and writable only by the owner.
+
+    Returns:
+        tuple: (file descriptor open for reading and writing, path of the file)
+    """
+    for name in _temp_names(dir_name, prefix, suffix):
+        try:
+            return os.open(name, _TEMP_OPEN_FLAGS, 0o600), name
+        except FileExistsError:
+            continue  # left behind by a process with the same pid, try the next name
+    raise FileExistsError(errno.EEXIST, 'No usable temporary file name found', dir_name)
+
+
+# Whether files created with O_TMPFILE can be named by linking
+# /proc/self/fd/N; cleared when that fails because /proc is not mounted
+_use_o_tmpfile = hasattr(os, 'O_TMPFILE')
+# errors of O_TMPFILE on kernels or filesystems that do not support it
+_O_TMPFILE_UNSUPPORTED = frozenset((errno.EISDIR, errno.EOPNOTSUPP, errno.EINVAL))
+# The directory is only used as the base of openat/linkat: O_PATH needs no
+# read permission on it, as when writing into a directory of mode 0333
+_TMPFILE_DIR_FLAGS = getattr(os, 'O_PATH', os.O_RDONLY) | getattr(os, 'O_DIRECTORY', 0)
+
+
+def _write_unnamed_temp_file(dir_name, prefix, suffix, data, durable, encoding):
+    """Write data to a file created without a name (O_TMPFILE) in dir_name, then name it.
+
+    The file appears in the directory only once it is complete, so a write
+    that fails or is interrupted by a crash leaves nothing behind.
+
+    Returns:
+        str: path of the file, or None if O_TMPFILE cannot be used here
+    """
+    global _use_o_tmpfile
+    if not _use_o_tmpfile:
+        return None
+    # os.link calls linkat, that can follow the /proc link, only when
+    # given a directory descriptor
+    try:
+        dir_fd = os.open(dir_name, _TMPFILE_DIR_FLAGS)
+    except PermissionError:
+        return None  # fall back to a named temporary file
+    try:
+        try:
+            fd = os.open('.', os.O_TMPFILE | os.O_WRONLY, 0o600, dir_fd=dir_fd)
+        except OSError as e:
+            if e.errno in _O_TMPFILE_UNSUPPORTED:
+                return None
+            raise
+        try:
+            _write_content(fd, data, durable, encoding)
+            proc_path = '/proc/self/fd/%d' % fd
+            for name in _temp_names(dir_name, prefix, suffix):
+                try:
+                    os.link(proc_path, os.path.basename(name), dst_dir_fd=dir_fd)
+                    return name
+                except FileExistsError:
+                    continue  # left behind by a process with the same pid, try the next name
+                except FileNotFoundError:
+                    # Also raised when the directory is removed meanwhile
+                    if os.path.isdir('/proc/self/fd'):
+                        raise
+                    _use_o_tmpfile = False
+                    return None
+            raise FileExistsError(errno.EEXIST, 'No usable temporary file name found', dir_name)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _write_all(fd, data):
+    """Write all of data to the descriptor fd, going on after short writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# str content longer than this is encoded while written, in slices of
+# _ENCODE_CHUNK_SIZE characters, instead of all at once before locking,
+# so that its whole encoding is never in memory
+_ENCODE_AT_ONCE_MAX = 1 << 20
+_ENCODE_CHUNK_SIZE = 1 << 16
+
+
+def _write_text(fd, text, encoding):
+    """Write text, encoded with encoding in slices, to the descriptor fd."""
+    encoder = codecs.getincrementalencoder(encoding)()
+    for start in range(0, len(text), _ENCODE_CHUNK_SIZE):
+        _write_all(fd, encoder.encode(text[start:start + _ENCODE_CHUNK_SIZE]))
+    _write_all(fd, encoder.encode('', final=True))
+
+
+def _fsync_dir(dir_name):
+    """Flush the entries of the directory dir_name, so that a rename done in it survives a crash.
+
+    Directories cannot be opened for this on Windows, where it does nothing,
+    nor without read permission on them, where the rename is left unsynced.
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    try:
+        fd = os.open(dir_name, os.O_RDONLY | os.O_DIRECTORY)
+    except PermissionError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # some filesystems do not support syncing directories
+        if e.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(fd)
+
+
+# Temporary files of at least this size are preallocated before writing
+_PREALLOCATE_MIN_SIZE = 1 << 20
+
+
+def _write_content(fd, data, durable, encoding):
+    """Write data to the new file open as fd, syncing it if durable.
+
+    data is bytes, or str to encode with encoding.
+    """
+    # for str, the length is a lower bound of the encoded size
+    if len(data) >= _PREALLOCATE_MIN_SIZE:
+        _preallocate(fd, len(data))
+    if isinstance(data, str):
+        _write_text(fd, data, encoding)
+    else:
+        _write_all(fd, data)
+    if durable:
+        os.fsync(fd)
+
+
+def _preallocate(fd, size):
+    """Reserve size bytes for the file open as fd, so that they are allocated in one go.
+
+    This is only a hint: it does nothing where posix_fallocate is not available
+    or not supported by the filesystem.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
 
 
 #################################### atomic calls
 
-def atomic_write_content_with_lock(filepath, content, use_lock=True, timeout=None, temp_suffix='.tmp'):
+def _unlink_quietly(path):
+    """Remove path, ignoring errors, as for a temporary file that may already be gone."""
+    try:
+        os.unlink(path)
+    except Exception:
+        pass
+
+
+def _prepare_content(content):
+    """Return (data, encoding) to write content as a file opened in text mode would.
+
+    bytes need no encoding; str is encoded at once, unless it is so long
+    that it is better encoded in slices while written.
+    """
+    if not isinstance(content, str):
+        return content, None
+    if os.linesep != '\n':
+        content = content.replace('\n', os.linesep)
+    encoding = locale.getpreferredencoding(False)
+    if len(content) <= _ENCODE_AT_ONCE_MAX:
+        content = content.encode(encoding)
+    return content, encoding
+
+
+def _write_temp_file(target_name, filepath, data, temp_suffix, durable, encoding=None):
+    """Write data to a new temporary file next to target_name, and return its path.
+
+    filepath is the path given by the caller, that names the temporary file;
+    data is bytes, or str to encode with encoding.
+    """
+    # Create a unique temporary file in the same directory as the target (not the symlink)
+    dir_name = os.path.dirname(target_name) or '.'
+    prefix = os.path.basename(filepath) + '_'
+
+    temp_file = _write_unnamed_temp_file(dir_name, prefix, temp_suffix, data, durable, encoding)
+    if temp_file is None:
+        # Create temporary file with unique name in target directory
+        fd, temp_file = _create_temp_file(dir_name, prefix, temp_suffix)
+
+        # Write to temporary file through the descriptor, without a buffered file object
+        try:
+            try:
+                _write_content(fd, data, durable, encoding)
+            finally:
+                os.close(fd)
+        except Exception:
+            # Clean up temporary file on failure
+            _unlink_quietly(temp_file)
+            raise
+    return temp_file
+
+
+def _rename_temp_file(temp_file, target_name):
+    """Rename temp_file over target_name, with the permissions of target_name.
+
+    temp_file is removed if this fails.
+    """
+    try:
+        # Preserve file permissions if the target file existed
+        st_mode = None
+        try:
+            st_mode = os.stat(target_name).st_mode
+            os.chmod(temp_file, st_mode)
+        except FileNotFoundError:
+            pass
+        except (OSError, IOError) as E:
+            # If permission copy fails, continue anyway
+            logger.error(f'Could not preserve permission {st_mode} for {target_name} : {E}')
+
+        # Atomic replace keeps the write single-step across platforms
+        os.replace(temp_file, target_name)
+
+    except Exception:
+        # Clean up temporary file on failure
+        _unlink_quietly(temp_file)
+        raise
+
+
+def _do_write_and_rename(target_name, filepath, data, temp_suffix, durable, encoding=None):
+    """Write data to a new temporary file next to target_name, then rename it over target_name.
+
+    filepath is the path given by the caller, that names the temporary file;
+    data is bytes, or str to encode with encoding.
+    """
+    temp_file = _write_temp_file(target_name, filepath, data, temp_suffix, durable, encoding)
+    _rename_temp_file(temp_file, target_name)
+    if durable:
+        # Make the rename itself durable
+        _fsync_dir(os.path.dirname(target_name) or '.')
+
+
+def _resolve_target(filepath):
+    """Return (absolute filepath, file to replace), checking that filepath is not a non-file."""
+    # Resolve symlinks to get the actual target file, but preserve the symlink itself
+    filepath = _abspath(filepath)
+
+    st, target_name = _stat_and_resolve(filepath)
+
+    # Check if the path exists and is not a regular file (or symlink to file)
+    if st is not None and not stat.S_ISREG(st.st_mode):
+        raise RuntimeError('Works only on files, not %r' % filepath)
+    return filepath, target_name
+
+
+def atomic_write_content_with_lock(filepath, content, use_lock=True, timeout=None, temp_suffix='.tmp',
+                                   durable=False):
     """
     Atomically write content to a file with optional locking.
 
@@ -392,6 +1092,8 @@ def atomic_write_content_with_lock(filepath, content, use_lock=True, timeout=Non
         use_lock (bool): Whether to use file locking (default: True)
         timeout (float): Lock timeout in seconds (None = wait indefinitely)
         temp_suffix (str): Suffix for temporary file (default: '.tmp')
+        durable (bool): Whether to fsync the temporary file before renaming it,
+                        and its directory after (default: False)
 
     Raises:
         LockTimeout: If lock cannot be acquired within timeout
@@ -401,73 +1103,101 @@ def atomic_write_content_with_lock(filepath, content, use_lock=True, timeout=Non
     Returns:
         None
     """
-    # Resolve symlinks to get the actual target file, but preserve the symlink itself
-    filepath = os.path.abspath(filepath)
+    filepath, target_name = _resolve_target(filepath)
 
-    # Check if the path exists and is not a regular file (or symlink to file)
-    if os.path.exists(filepath) and not os.path.isfile(filepath):
-        raise RuntimeError('Works only on files, not %r' % filepath)
+    # Encode before taking the lock
+    content, encoding = _prepare_content(content)
 
-    target_name = filepath
+    # Execute with or without locking
+    if use_lock and not _LOCK_IS_NOOP:
+        lock = mylockfile(target_name, timeout=timeout)
+        with lock:
+            _do_write_and_rename(target_name, filepath, content, temp_suffix, durable, encoding)
+    else:
+        _do_write_and_rename(target_name, filepath, content, temp_suffix, durable, encoding)
 
-    if os.path.islink(filepath):
-        readlink = os.readlink(filepath)
-        if os.path.isabs(readlink):
-            target_name = readlink
-        else:
-            target_name = os.path.join(os.path.dirname(filepath), readlink)
 
-    def _write_and_rename():
-        """Inner function that performs the actual write and rename."""
-        # Create a unique temporary file in the same directory as the target (not the symlink)
-        dir_name = os.path.dirname(target_name) or '.'
-        base_name = os.path.basename(filepath)
+def atomic_write_many(items, use_lock=True, timeout=None, temp_suffix='.tmp', durable=False,
+                      max_workers=4):
+    """
+    Atomically write content to several files, as atomic_write_content_with_lock does for each.
 
-        # Use tempfile to create a unique temporary file
-        mode = 'wb' if isinstance(content, bytes) else 'w'
-        fd = None
-        temp_file = None
+    The temporary files are written first, by up to max_workers threads and
+    without holding any lock. Then the locks of all the target files are
+    acquired in sorted order, so that concurrent calls cannot deadlock, and
+    each temporary file is renamed over its target. With durable=True, each
+    directory is synced once, after all the renames in it.
 
-        try:
-            # Create temporary file with unique name in target directory
-            fd = tempfile.mkstemp(dir=dir_name, prefix=base_name + '_', suffix=temp_suffix)
-            temp_file = fd[1]  # Get the filename
-            os.close(fd[0])  # Close the file descriptor
+    Each file is replaced atomically, but the set of files is not: if a
+    rename fails, the files renamed before it keep their new content.
 
-            # Write to temporary file
-            with open(temp_file, mode) as f:
-                f.write(content)
+    Args:
+        items: Mapping of target paths to content (str or bytes), or iterable
+               of (filepath, content) pairs; a later pair for the same target
+               file, also through a symlink or a symlinked directory,
+               replaces an earlier one
+        use_lock (bool): Whether to use file locking (default: True)
+        timeout (float): Timeout of each lock in seconds (None = wait indefinitely)
+        temp_suffix (str): Suffix for temporary files (default: '.tmp')
+        durable (bool): Whether to fsync the temporary files before renaming them,
+                        and their directories after (default: False)
+        max_workers (int): Number of threads writing temporary files (default: 4)
 
-            # Preserve file permissions if the target file existed
-            if os.path.exists(target_name):
-                st_mode = None
-                try:
-                    original_stat = os.stat(target_name)
-                    st_mode = original_stat.st_mode
-                    os.chmod(temp_file, st_mode)
-                except (OSError, IOError) as E:
-                    # If permission copy fails, continue anyway
-                    logger.error(f'Could not preserve permission {st_mode} for {target_name} : {E}')
+    Raises:
+        LockTimeout: If a lock cannot be acquired within timeout
+        IOError: If file operations fail
+        OSError: If a rename fails or permissions issues
 
-            # Atomic replace keeps the write single-step across platforms
-            os.replace(temp_file, target_name)
+    Returns:
+        None
+    """
+    if hasattr(items, 'items'):
+        items = items.items()
+    # target file, in its directory with symlinks resolved ->
+    # (filepath, data, encoding); paths reaching the same file are merged,
+    # as its lock cannot be taken twice
+    writes = {}
+    for filepath, content in items:
+        filepath, target_name = _resolve_target(filepath)
+        target_name = os.path.join(os.path.realpath(os.path.dirname(target_name)),
+                                   os.path.basename(target_name))
+        writes[target_name] = (filepath,) + _prepare_content(content)
+
+    # target file -> temporary file not yet renamed
+    temp_files = {}
+
+    def write(target_name):
+        filepath, data, encoding = writes[target_name]
+        temp_files[target_name] = _write_temp_file(target_name, filepath, data, temp_suffix,
+                                                   durable, encoding)
+
+    try:
+        if max_workers > 1 and len(writes) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(writes))) as executor:
+                futures = [executor.submit(write, target_name) for target_name in writes]
+            # All writes are done: raise the first failure, if any
+            for future in futures:
+                future.result()
+        else:
+            for target_name in writes:
+                write(target_name)
+
+        with contextlib.ExitStack() as stack:
+            if use_lock and not _LOCK_IS_NOOP:
+                for target_name in sorted(writes):
+                    stack.enter_context(mylockfile(target_name, timeout=timeout))
+            for target_name in writes:
+                _rename_temp_file(temp_files.pop(target_name), target_name)
+    finally:
+        # Clean up the temporary files not renamed, on failure
+        for temp_file in temp_files.values():
+            _unlink_quietly(temp_file)
+
+    if durable:
+        # Make the renames themselves durable
+        for dir_name in {os.path.dirname(target_name) or '.' for target_name in writes}:
+            _fsync_dir(dir_name)
 
-        except Exception:
-            # Clean up temporary file on failure
-            if temp_file and os.path.exists(temp_file):
-                try:
-                    os.unlink(temp_file)
-                except Exception:
-                    pass  # Ignore cleanup errors
-            raise
-
-    # Execute with or without locking
-    if use_lock:
-        lock = mylockfile(target_name, timeout=timeout)
-        with lock:
-            _write_and_rename()
-    else:
-        _write_and_rename()
 
 class atomic_write_no_lock(object):
     """Context manager for atomically writing to a file without locking.
@@ -480,16 +1210,24 @@ class atomic_write_no_lock(object):
     Does NOT use file locking - use atomic_write_lock for concurrent access.
     """
 
+    # A writer is created for every write, so avoid the per-instance __dict__
+    __slots__ = ('filename', 'mode', 'mode_behaviour', 'buffering', 'encoding',
+                 'errors', 'newline', 'closefd', '_temp_file', '_temp_filename',
+                 'V', 'st_mode', 'target_name', 'target_dir', '_open_kwargs',
+                 '_temp_dir', '_temp_prefix', '_temp_suffix', 'durable')
+
     def __init__(self, filename, mode='w', buffering=-1, encoding=None,
-                 errors=None, newline=None, closefd=True, **V):
+                 errors=None, newline=None, closefd=True, durable=False, **V):
         """Initialize the atomic file writer.
 
         Args:
             filename: The target file to write to atomically
             mode, buffering, encoding, errors, newline, closefd:
                 Same parameters as built-in open() function
+            durable: Whether to fsync the temporary file before renaming it,
+                and its directory after (default: False)
         """
-        self.filename = os.path.abspath(filename)
+        self.filename = _abspath(filename)
         self.mode = mode
         self.mode_behaviour = open_modes_behaviour(mode)
         self.buffering = buffering
@@ -497,19 +1235,34 @@ class atomic_write_no_lock(object):
         self.errors = errors
         self.newline = newline
         self.closefd = closefd
+        self.durable = durable
         self._temp_file = None
         self._temp_filename = None
         self.V = V
         self.st_mode = None
 
-    def __enter__(self):
-        """Create and open a temporary file for writing."""
+        # Arguments for the temporary file, computed once for all the uses;
+        # don't pass encoding parameters in binary mode
+        open_kwargs = {'mode': mode, 'buffering': buffering}
+        if self.mode_behaviour.text:
+            open_kwargs.update(encoding=encoding, errors=errors, newline=newline)
+        open_kwargs.update(V)
+        # The temporary file is renamed, never deleted on close
+        open_kwargs.pop('delete', None)
+        self._temp_dir = open_kwargs.pop('dir', None)
+        self._temp_prefix = open_kwargs.pop('prefix', os.path.basename(self.filename) + '_')
+        self._temp_suffix = open_kwargs.pop('suffix', '.tmp')
+        self._open_kwargs = open_kwargs
+
+    def _check_target(self):
+        """Raise if the file cannot be written atomically with the requested mode."""
         # Check for read-only mode - atomic write doesn't make sense for read-only
         if not self.mode_behaviour.write:
             raise ValueError('atomic_write_no_lock does not support read-only mode: %r' % self.mode)
 
         # Check if the path exists and is not a regular file (or symlink to file)
-        if os.path.exists(self.filename):
+        st = _stat_if_exists(self.filename)
+        if st is not None:
             # note that exclusive opening will not tranverse thru symlinks!
             if self.mode_behaviour.exclusive:
                 raise FileExistsError(
@@ -517,7 +1270,7 @@ class atomic_write_no_lock(object):
                     os.strerror(errno.EEXIST),
                     self.filename,
                 )
-            if not os.path.isfile(self.filename):
+            if not stat.S_ISREG(st.st_mode):
                 raise RuntimeError('Works only on files, not %r' % self.filename)
         elif self.mode_behaviour.must_exist:
             # this triggers also on dangling symlinks
@@ -527,23 +1280,22 @@ class atomic_write_no_lock(object):
                 self.filename,
             )
 
+    def __enter__(self):
+        """Create and open a temporary file for writing."""
+        self._check_target()
+
         # Handle symlinks - resolve the target but preserve the symlink
-        self.target_name = self.filename
-        if os.path.islink(self.filename):
-            readlink = os.readlink(self.filename)
-            if os.path.isabs(readlink):
-                self.target_name = readlink
-            else:
-                self.target_name = os.path.join(os.path.dirname(self.filename), readlink)
+        self.target_name = _resolve_symlink(self.filename)
 
 
-        if os.path.exists(self.target_name):
-            try:
-                original_stat = os.stat(self.target_name)
-                self.st_mode = original_stat.st_mode
-            except (OSError, IOError) as E:
-                # If permission copy fails, continue anyway
-                logger.error(f'Could not read permission for {self.target_name} : {E}')
+        self.st_mode = None
+        try:
+            self.st_mode = os.stat(self.target_name).st_mode
+        except FileNotFoundError:
+            pass
+        except (OSError, IOError) as E:
+            # If permission copy fails, continue anyway
+            logger.error(f'Could not read permission for {self.target_name} : {E}')
 
         self.target_dir = os.path.dirname(self.target_name)
         # Ensure the target directory exists
@@ -551,61 +1303,44 @@ class atomic_write_no_lock(object):
         #    os.makedirs(target_dir)
 
         # Create a temporary file in the same directory as the target file
-        D = self.target_dir
-
-        # Build kwargs - don't pass encoding parameters in binary mode
-        kwargs = {
-            'mode': self.mode,
-            'buffering': self.buffering,
-            'delete': False,
-            'dir': D if D else '.',
-            'prefix': os.path.basename(self.filename) + '_',
-            'suffix': '.tmp'
-        }
-
-        # Only add text-mode parameters if not in binary mode
-        if self.mode_behaviour.text:
-            kwargs['encoding'] = self.encoding
-            kwargs['errors'] = self.errors
-            kwargs['newline'] = self.newline
+        fd, self._temp_filename = _create_temp_file(self._temp_dir or self.target_dir or '.',
+                                                    self._temp_prefix, self._temp_suffix)
+        # Open the new descriptor by name, so that the file object is named after it
+        opened = []
 
-        # Merge in any additional kwargs from **V
-        kwargs.update(self.V)
+        def opener(path, flags):
+            opened.append(fd)
+            return fd
 
-        self._temp_file = tempfile.NamedTemporaryFile(**kwargs)
-        self._temp_filename = self._temp_file.name
+        try:
+            self._temp_file = open(self._temp_filename, opener=opener, **self._open_kwargs)
+        except Exception:
+            if not opened:
+                os.close(fd)  # otherwise open() closed it
+            try:
+                os.remove(self._temp_filename)
+            except Exception:
+                pass
+            raise
 
         # For append mode or update modes, copy existing content to temp file
         # This applies to: 'a', 'a+', 'r+', 'w+', 'ab', 'a+b', 'r+b', 'w+b'
-        if os.path.exists(self.target_name) and not self.mode_behaviour.truncate:
-            # Copy the existing file content to the temporary file using COW when available
+        # (st_mode tells whether the target existed, without another stat)
+        if not self.mode_behaviour.truncate and self.st_mode is not None:
+            # Copy the existing file content to the temporary file, sharing
+            # extents on COW filesystems when copy_file_range can
             try:
                 self._temp_file.close()
-                reflinked = False
-                if CP_HAS_REFLINK:
-                    # Use cp with --reflink=auto to exploit COW filesystems (btrfs, xfs, etc.)
-                    proc = subprocess.run(["cp", "-p", CP_HAS_REFLINK, str(self.target_name), str(self._temp_filename)],
-                                          capture_output=True)
-                    reflinked = 0 == (proc.returncode)
-                    if not reflinked:
-                        logger.warning(f'`cp -p {CP_HAS_REFLINK} {self.target_name!s} {self._temp_filename!s}` failed,'
-                                       f' stdout={proc.stdout} ,stderr={proc.stderr}')
-                if not reflinked:
-                    shutil.copy2(self.target_name, self._temp_filename, follow_symlinks=True)
+                _copy_file(self.target_name, self._temp_filename)
 
                 # Reopen the temp file in the requested mode
-                self._temp_file = open(self._temp_filename, self.mode,
-                                      buffering=self.buffering,
-                                      encoding=self.encoding if self.mode_behaviour.text else None,
-                                      errors=self.errors if self.mode_behaviour.text  else None,
-                                      newline=self.newline if self.mode_behaviour.text else None)
+                self._temp_file = open(self._temp_filename, **self._open_kwargs)
             except Exception:
                 # Clean up temp file on failure
-                if os.path.exists(self._temp_filename):
-                    try:
-                        os.remove(self._temp_filename)
-                    except Exception:
-                        pass
+                try:
+                    os.remove(self._temp_filename)
+                except Exception:
+                    pass
                 raise
 
         return self._temp_file
@@ -614,34 +1349,53 @@ class atomic_write_no_lock(object):
         """Close the temporary file and move it to the target filename if no exceptions occurred."""
         # Always close the file
         if self._temp_file:
+            if exc_type is None and self.durable:
+                self._sync_temp_file()
             self._temp_file.close()
 
         # If there was no exception, atomically move the temp file to the target file
         if exc_type is None:
             # Preserve file permissions if the target file existed
-            if os.path.exists(self.target_name):
-                st_mode = None
-                try:
-                    original_stat = os.stat(self.target_name)
-                    st_mode = original_stat.st_mode
-                    if st_mode != self.st_mode:
-                        logger.warning('File %r mode changed during writing, from %s to %s ',
-                                       self.target_name, self.st_mode, st_mode)
-                    os.chmod(self._temp_filename, st_mode)
-                except (OSError, IOError) as E:
-                    # If permission copy fails, continue anyway
-                    logger.error(f'Could not preserve permission {st_mode} for {self.target_name} : {E}')
+            st_mode = None
+            try:
+                st_mode = os.stat(self.target_name).st_mode
+                if st_mode != self.st_mode:
+                    logger.warning('File %r mode changed during writing, from %s to %s ',
+                                   self.target_name, self.st_mode, st_mode)
+                os.chmod(self._temp_filename, st_mode)
+            except FileNotFoundError:
+                pass
+            except (OSError, IOError) as E:
+                # If permission copy fails, continue anyway
+                logger.error(f'Could not preserve permission {st_mode} for {self.target_name} : {E}')
 
             # Move the temp file to the destination (preserves symlink if filename was a symlink)
             os.replace(self._temp_filename, self.target_name)
+            if self.durable:
+                # Make the rename itself durable
+                _fsync_dir(self.target_dir or '.')
         else:
             # If there was an exception, remove the temp file
-            if os.path.exists(self._temp_filename):
+            try:
                 os.remove(self._temp_filename)
+            except FileNotFoundError:
+                pass
 
         # Don't suppress exceptions
         return False
 
+    def _sync_temp_file(self):
+        """Flush the temporary file to disk, even if the caller already closed it."""
+        if not self._temp_file.closed:
+            self._temp_file.flush()
+            os.fsync(self._temp_file.fileno())
+            return
+        fd = os.open(self._temp_filename, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
 
 class atomic_write_lock(atomic_write_no_lock):
     """Context manager for atomically writing to a file WITH file locking.
@@ -654,8 +1408,10 @@ class atomic_write_lock(atomic_write_no_lock):
     and uses mylockfile for concurrent access protection.
     """
 
+    __slots__ = ('lock_timeout', '_lock')
+
     def __init__(self, filename, mode='w', buffering=-1, encoding=None,
-                 errors=None, newline=None, closefd=True, lock_timeout=None, **V):
+                 errors=None, newline=None, closefd=True, lock_timeout=None, durable=False, **V):
         """Initialize the atomic file writer with locking.
 
         Args:
@@ -663,39 +1419,37 @@ class atomic_write_lock(atomic_write_no_lock):
             mode, buffering, encoding, errors, newline, closefd:
                 Same parameters as built-in open() function
             lock_timeout: Timeout for lock acquisition (None = wait indefinitely)
+            durable: Whether to fsync the temporary file before renaming it,
+                and its directory after (default: False)
         """
         # Call parent constructor
         super().__init__(filename, mode=mode, buffering=buffering, encoding=encoding,
-                        errors=errors, newline=newline, closefd=closefd, **V)
+                        errors=errors, newline=newline, closefd=closefd, durable=durable, **V)
 
         self.lock_timeout = lock_timeout
         self._lock = None
 
     def __enter__(self):
         """Acquire lock and create temporary file for writing."""
-        # First, acquire the lock using mylockfile. Lock the resolved target so
-        # aliases and read-only symlink parents behave consistently.
-        lock_target = self.filename
-        if os.path.islink(lock_target):
-            readlink = os.readlink(lock_target)
-            if os.path.isabs(readlink):
-                lock_target = readlink
-            else:
-                lock_target = os.path.join(os.path.dirname(lock_target), readlink)
-        self._lock = mylockfile(os.path.abspath(lock_target), timeout=self.lock_timeout)
-        self._lock.__enter__()
+        # Reject unusable targets without waiting for the lock; the checks
+        # are repeated by the parent's __enter__ once the lock is held
+        self._check_target()
 
-        try:
-            # Call parent's __enter__ to create the temporary file
+        if _LOCK_IS_NOOP:
+            self._lock = None
             return super().__enter__()
-        except Exception:
-            # If temp file creation fails, release the lock
-            if self._lock:
-                try:
-                    self._lock.__exit__(None, None, None)
-                except Exception:
-                    pass  # Ignore errors during cleanup
-            raise
+
+        # Then, acquire the lock using mylockfile. Lock the resolved target so
+        # aliases and read-only symlink parents behave consistently.
+        lock_target = _resolve_symlink(self.filename)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mylockfile(_abspath(lock_target), timeout=self.lock_timeout))
+            # Call parent's __enter__ to create the temporary file; if that
+            # fails, leaving the stack releases the lock
+            f = super().__enter__()
+            # Keep the lock held until __exit__
+            self._lock = stack.pop_all()
+        return f
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Close temp file, move to target if successful, and release lock."""
@@ -703,12 +1457,13 @@ class atomic_write_lock(atomic_write_no_lock):
             # Call parent's __exit__ to handle file operations
             super().__exit__(exc_type, exc_val, exc_tb)
         finally:
-            # Always release the lock by calling mylockfile's __exit__
-            if self._lock:
+            # Always release the lock, kept in the stack by __enter__
+            if self._lock is not None:
                 try:
                     self._lock.__exit__(exc_type, exc_val, exc_tb)
                 except Exception:
                     pass  # Ignore errors during lock release
+                self._lock = None
 
         # Don't suppress exceptions
         return False